@@ -0,0 +1,238 @@
+'''Benchmarks for the reStUtil rendering hot paths.
+
+Times and memory-profiles table rendering, deeply nested sections, text
+wrapping, container accumulation and whole document writes.  Results may be
+saved as a JSON baseline and later runs compared against it, e.g.::
+
+  $> python benchmarks/run_benchmarks.py --save benchmarks/baseline.json
+  $> python benchmarks/run_benchmarks.py --compare benchmarks/baseline.json
+
+A comparison exits with a nonzero status if any benchmark is slower, or has a
+higher peak memory, than the baseline by more than *--threshold*.  Timings
+are the best of several repeats, peak memory is measured with tracemalloc in
+a separate run so it does not distort the timings.
+'''
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from reStUtil import (ReStContainer, ReStDocument, ReStHyperlink, ReStSection,
+                      ReStSimpleTable, ReStTable, ReStText, deserialize, serialize)
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do '
+         'eiusmod tempor incididunt ut labore et dolore magna aliqua').split()
+# wide, fullwidth, accented and combining text as well as plain ASCII
+MULTILINGUAL_WORDS = WORDS+['東京','数据','テーブル','서울','ｆｕｌｌ','café','naïve','e\u0301t\u00e9','😀']
+
+class NullFile(object) :
+    'file-like object that discards what is written to it'
+    def write(self,s) :
+        pass
+
+def sentence(rng,n,words=WORDS) :
+    return ' '.join(rng.choice(words) for i in range(n))
+
+def table_rows(n,cols=3,multiline=False,seed=0,words=WORDS) :
+    rng = random.Random(seed)
+    rows = []
+    for i in range(n) :
+        row = [i,rng.random()*1000,sentence(rng,3,words)]+[rng.randint(0,10**6) for j in range(cols-3)]
+        if multiline :
+            row[2] = row[2].replace(' ','\n',1)
+        rows.append(row)
+    return rows
+
+def bench_simple_table(n,cols=3,multiline=False,words=WORDS) :
+    header = ['col%d'%i for i in range(cols)]
+    rows = table_rows(n,cols,multiline,words=words)
+    def run() :
+        ReStSimpleTable(header,rows).render_to(NullFile())
+    return run
+
+def bench_section_tree(depth,children) :
+    def run() :
+        top = sec = ReStSection('Section 1')
+        for level in range(2,depth+1) :
+            sub = ReStSection('Section %d'%level)
+            sec.add(sub)
+            sec = sub
+        for i in range(children) :
+            sec.add('child text %d'%i)
+        top.get_text()
+    return run
+
+def bench_text_wrap(paragraphs,words) :
+    rng = random.Random(1)
+    texts = [sentence(rng,words) for i in range(paragraphs)]
+    def run() :
+        for t in texts :
+            ReStText(t).get_text()
+    return run
+
+def bench_container_add(n) :
+    def run() :
+        cont = ReStContainer()
+        for i in range(n) :
+            cont += 'text %d'%i
+        cont.get_text()
+    return run
+
+def bench_document_write(sections,rows) :
+    def run() :
+        with tempfile.TemporaryFile('w') as f :
+            doc = ReStDocument(f,title='Benchmark Report')
+            rng = random.Random(2)
+            for i in range(sections) :
+                sec = ReStSection('Section %d'%i)
+                sec.add(sentence(rng,200))
+                sec.add(ReStTable(['a','b','c'],table_rows(rows,seed=i),title='Table %d'%i))
+                doc.add(sec)
+            doc.write()
+    return run
+
+def bench_serialize(kind,n,use_pickle=False) :
+    # a dump and load of text and hyperlinks, or of a table, with serialize()
+    # or pickle for comparison
+    if kind == 'table' :
+        component = ReStTable(['a','b','c'],table_rows(n))
+    else :
+        rng = random.Random(3)
+        component = ReStSection('Section')
+        for i in range(n) :
+            component.add(ReStText(sentence(rng,20)))
+            component.add(ReStHyperlink('link%d'%i,'http://example.com/%d'%i))
+    def run() :
+        if use_pickle :
+            pickle.loads(pickle.dumps(component,pickle.HIGHEST_PROTOCOL))
+        else :
+            deserialize(serialize(component))
+    return run
+
+def benchmarks(quick=False) :
+    '''return the list of (name, factory) pairs, the factory returning the
+    function to time'''
+    table_sizes = [10**3,10**4] if quick else [10**3,10**4,10**5,10**6]
+    benches = []
+    for n in table_sizes :
+        benches.append(('simple_table_%d'%n,lambda n=n: bench_simple_table(n)))
+        if n <= 10**5 : # 20 columns of a million rows needs several GB
+            benches.append(('simple_table_wide_%d'%n,lambda n=n: bench_simple_table(n,cols=20)))
+        benches.append(('simple_table_multiline_%d'%n,lambda n=n: bench_simple_table(n,multiline=True)))
+        benches.append(('simple_table_multilingual_%d'%n,
+                        lambda n=n: bench_simple_table(n,words=MULTILINGUAL_WORDS)))
+    children = 1000 if quick else 5000
+    for depth in range(1,7) :
+        benches.append(('section_depth_%d'%depth,lambda d=depth: bench_section_tree(d,children)))
+    benches.append(('text_wrap',lambda: bench_text_wrap(100 if quick else 1000,500)))
+    benches.append(('container_add',lambda: bench_container_add(2000 if quick else 20000)))
+    benches.append(('document_write',lambda: bench_document_write(10 if quick else 100,1000)))
+    for kind, n in (('text',2000 if quick else 20000),('table',10**4 if quick else 10**5)) :
+        benches.append(('serialize_%s'%kind,lambda k=kind,n=n: bench_serialize(k,n)))
+        benches.append(('pickle_%s'%kind,lambda k=kind,n=n: bench_serialize(k,n,True)))
+    return benches
+
+def time_it(func,min_time,max_repeats) :
+    '''best wall time of repeated calls to func, repeating until min_time has
+    elapsed or max_repeats calls were made'''
+    best, total, repeats = None, 0., 0
+    while repeats < max_repeats and (repeats == 0 or total < min_time) :
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter()-start
+        best = elapsed if best is None else min(best,elapsed)
+        total += elapsed
+        repeats += 1
+    return best, repeats
+
+def peak_memory(func) :
+    tracemalloc.start()
+    try :
+        func()
+        return tracemalloc.get_traced_memory()[1]
+    finally :
+        tracemalloc.stop()
+
+def run(args) :
+    results = {}
+    for name, factory in benchmarks(args.quick) :
+        if args.filter and args.filter not in name :
+            continue
+        func = factory()
+        seconds, repeats = time_it(func,args.min_time,args.max_repeats)
+        peak = peak_memory(func) if not args.no_memory else None
+        results[name] = {'seconds':seconds,'repeats':repeats,'peak_bytes':peak}
+        sys.stdout.write('%-32s %10.4fs %6dx %14s\n'%(name,seconds,repeats,
+                         '-' if peak is None else '%d B'%peak))
+        sys.stdout.flush()
+    return results
+
+def compare(results,baseline,threshold) :
+    '''print the ratio of each result to the baseline, returns the names of
+    the benchmarks that regressed beyond threshold'''
+    regressions = []
+    sys.stdout.write('\n%-32s %10s %10s\n'%('benchmark','time','memory'))
+    for name, res in results.items() :
+        base = baseline.get(name)
+        if base is None :
+            sys.stdout.write('%-32s %10s %10s\n'%(name,'new','new'))
+            continue
+        time_ratio = res['seconds']/base['seconds']
+        mem_ratio = None
+        if res['peak_bytes'] and base.get('peak_bytes') :
+            mem_ratio = float(res['peak_bytes'])/base['peak_bytes']
+        regressed = time_ratio > threshold or (mem_ratio or 0) > threshold
+        sys.stdout.write('%-32s %9.2fx %10s%s\n'%(name,time_ratio,
+                         '-' if mem_ratio is None else '%.2fx'%mem_ratio,
+                         '  REGRESSION' if regressed else ''))
+        if regressed :
+            regressions.append(name)
+    return regressions
+
+def main(argv=None) :
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--save',metavar='JSON',help='write the results to this baseline file')
+    parser.add_argument('--compare',metavar='JSON',help='compare the results to this baseline file')
+    parser.add_argument('--threshold',type=float,default=1.25,
+                        help='ratio to the baseline above which a result is a regression [%(default)s]')
+    parser.add_argument('--quick',action='store_true',help='smaller sizes for a fast check')
+    parser.add_argument('--filter',help='only run benchmarks whose name contains this string')
+    parser.add_argument('--min-time',type=float,default=1.,
+                        help='repeat each benchmark for at least this many seconds [%(default)s]')
+    parser.add_argument('--max-repeats',type=int,default=5,
+                        help='repeat each benchmark at most this many times [%(default)s]')
+    parser.add_argument('--no-memory',action='store_true',help='skip peak memory measurement')
+    args = parser.parse_args(argv)
+
+    results = run(args)
+
+    if args.save :
+        with open(args.save,'w') as f :
+            json.dump({'python':platform.python_version(),
+                       'platform':platform.platform(),
+                       'quick':args.quick,
+                       'results':results},f,indent=2,sort_keys=True)
+            f.write('\n')
+
+    if args.compare :
+        with open(args.compare) as f :
+            baseline = json.load(f)
+        if baseline.get('quick',False) != args.quick :
+            sys.stderr.write('Warning: baseline was run with quick=%s\n'%baseline.get('quick'))
+        regressions = compare(results,baseline['results'],args.threshold)
+        if regressions :
+            sys.stderr.write('\n%d benchmark(s) regressed: %s\n'%(len(regressions),', '.join(regressions)))
+            return 1
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit(main())
@@ -5,30 +5,773 @@ documents.
 
 '''
 
+import argparse
+import array
+import asyncio
+import codecs
+import collections
+import concurrent.futures
+import copy
+import csv
+import functools
+import hashlib
+import importlib
+import inspect
+import io
+import itertools
+import json
+import marshal
+import operator
+import os
+import pickle
+import re
 import sys
+import tempfile
 import textwrap
+import threading
+import time
+import unicodedata
+import zlib
 
 
 class ReStUtilException(Exception) : pass
 
+# held while adding to containers, so components can be added from several
+# threads, and notified when a ReStReservation is done
+_ADD_LOCK = threading.RLock()
+_FILLED = threading.Condition(_ADD_LOCK)
+
+def _next_batch(chunks,size) :
+    return list(itertools.islice(chunks,size))
+
+async def _aiter_in_executor(chunks,executor,batch_size=256) :
+    # pull chunks from a blocking iterator in batches run in executor
+    loop = asyncio.get_running_loop()
+    chunks = iter(chunks)
+    while True :
+        batch = await loop.run_in_executor(executor,_next_batch,chunks,batch_size)
+        if not batch :
+            return
+        for chunk in batch :
+            yield chunk
+
+async def _awrite(stream,data,encoding,executor) :
+    if encoding is not None :
+        data = data.encode(encoding)
+    drain = getattr(stream,'drain',None)
+    if drain is None and executor is not None and not inspect.iscoroutinefunction(stream.write) :
+        # blocking file, write from the executor
+        await asyncio.get_running_loop().run_in_executor(executor,stream.write,data)
+        return
+    result = stream.write(data)
+    if inspect.isawaitable(result) :
+        await result
+    if drain is not None :
+        await drain()
+
+# textwrap.TextWrapper replaces each of these with a space, tabs excluded
+# here because they are expanded to a variable number of spaces instead
+_WRAP_SPACES = str.maketrans('\n\x0b\x0c\r','    ')
+_WRAP_CHUNKS = re.compile(r' +|[^ ]+')
+# characters _fast_fill cannot handle, hyphens break words, tabs expand and
+# \x1c-\x1f are not split on but are stripped as whitespace by TextWrapper
+_WRAP_SLOW_CHARS = re.compile(r'[-\t\x1c-\x1f]')
+
+# paragraphs longer than this are wrapped without caching
+WRAP_CACHE_MAX_LEN = 10000
+
+def _fill_single_spaced(text,width,initial_indent,subsequent_indent) :
+    # _fast_fill for text with single spaces between words and none at either
+    # end, lines are cut at the last space that fits rather than assembled
+    # chunk by chunk
+    lines = []
+    pos, end = 0, len(text)
+    indent = initial_indent
+    while pos < end :
+        line_width = width-len(indent)
+        stop = pos+line_width
+        if end <= stop :
+            lines.append(indent+text[pos:])
+            break
+        space = text.rfind(' ',pos,stop+1)
+        if space < 0 :
+            # the word is too long for any line
+            space = stop
+        elif space < stop :
+            # a next word too long for any line fills the rest of this one
+            word_end = text.find(' ',space+1)
+            if (word_end if word_end >= 0 else end)-space-1 > line_width :
+                space = stop
+        lines.append(indent+text[pos:space])
+        pos = space+1 if text[space:space+1] == ' ' else space
+        indent = subsequent_indent
+    return '\n'.join(lines)
+
+def _fast_fill(text,width,initial_indent='',subsequent_indent='') :
+    '''equivalent of textwrap.fill(text,width,initial_indent=initial_indent,
+    subsequent_indent=subsequent_indent,break_long_words=True) for ASCII text
+    without hyphens or tabs.  The chunking and line filling follow
+    TextWrapper._wrap_chunks exactly, but split chunks on spaces only rather
+    than with TextWrapper's hyphenation aware regular expression.  Texts
+    matching _WRAP_SLOW_CHARS, and widths not above the indents, must use
+    textwrap.'''
+    text = text.translate(_WRAP_SPACES)
+    if '  ' not in text and text[:1] != ' ' and text[-1:] != ' ' :
+        return _fill_single_spaced(text,width,initial_indent,subsequent_indent)
+
+    chunks = _WRAP_CHUNKS.findall(text)
+    chunks.reverse()
+    lines = []
+    while chunks :
+        indent = subsequent_indent if lines else initial_indent
+        line_width = width-len(indent)
+
+        # whitespace at the start of every line but the first is dropped
+        if lines and chunks[-1][0] == ' ' :
+            del chunks[-1]
+
+        cur_line, cur_len = [], 0
+        while chunks :
+            l = len(chunks[-1])
+            if cur_len+l <= line_width :
+                cur_line.append(chunks.pop())
+                cur_len += l
+            else :
+                break
+
+        # break a word too long for any line
+        if chunks and len(chunks[-1]) > line_width :
+            space_left = line_width-cur_len if line_width >= 1 else 1
+            chunk = chunks[-1]
+            cur_line.append(chunk[:space_left])
+            chunks[-1] = chunk[space_left:]
+
+        if cur_line and (not cur_line[-1] or cur_line[-1][0] == ' ') :
+            del cur_line[-1]
+
+        if cur_line :
+            lines.append(indent+''.join(cur_line))
+    return '\n'.join(lines)
+
+def _fill_uncached(text,width,initial_indent,subsequent_indent) :
+    if width > max(len(initial_indent),len(subsequent_indent)) and text.isascii() and \
+       not _WRAP_SLOW_CHARS.search(text) :
+        return _fast_fill(text,width,initial_indent,subsequent_indent)
+    return textwrap.fill(text,width,
+                         initial_indent=initial_indent,
+                         subsequent_indent=subsequent_indent,
+                         break_long_words=True)
+
+_fill_cached = functools.lru_cache(maxsize=4096)(_fill_uncached)
+
+def fill_text(text,width=80,initial_indent='',subsequent_indent='') :
+    '''wrap *text* to *width* like textwrap.fill with long words broken, as
+    used by ReStText and ReStFigure captions.  Results for paragraphs up to
+    WRAP_CACHE_MAX_LEN characters are kept in an LRU cache, so repeated
+    boilerplate is only wrapped once.'''
+    if len(text) > WRAP_CACHE_MAX_LEN :
+        return _fill_uncached(text,width,initial_indent,subsequent_indent)
+    return _fill_cached(text,width,initial_indent,subsequent_indent)
+
+# inline markup characters, and markup recognized at the start of a line:
+# comments and directives, bullets, enumerators, field and option lists,
+# doctest blocks, table borders, transitions and section adornments, as
+# well as indented lines, which start definition lists and block quotes,
+# and a :: ending a line, which starts a literal block.  The patterns follow
+# those of docutils.parsers.rst.states
+_INLINE_ESCAPES = str.maketrans(dict((c,'\\'+c) for c in '\\*`|_'))
+_OPTION_ARG = r'(?:[a-zA-Z][a-zA-Z0-9_-]*|<[^<>\n]+>)'
+_OPTION = r'(?:[-+][a-zA-Z0-9](?: ?%s)?|(?:--|/)[a-zA-Z0-9][a-zA-Z0-9_-]*(?:[ =]%s)?)'%(_OPTION_ARG,_OPTION_ARG)
+_LINE_START_MARKUP = re.compile(r'^(?:(?=[ \t]+\S)|\.\.|[-+\u2022\u2023\u2043](?=\s|$)|'
+                                r'\(?(?:\d+|[a-zA-Z]|[ivxlcdm]+|[IVXLCDM]+|#)[.)](?=\s|$)|>>>|'
+                                r':(?![: ])(?:[^:\\\n]|\\.|:(?![ `]|$))*(?<! ):(?=\s|$)|'
+                                r'%s(?:, %s)*(?=  | ?$)|\+-[-+]+-\+ *$|=+(?: +=+)+ *$|'
+                                r'([!-/:-@[-`{-~])\1* *$)'%(_OPTION,_OPTION),re.M)
+# substituted before the line start markup, which may take the same colons
+_LITERAL_MARKER = re.compile(r':(?=:[ \t]*$)',re.M)
+_ESCAPE_CHECK = re.compile(r'[\\*`|_]|'+_LINE_START_MARKUP.pattern+'|'+_LITERAL_MARKER.pattern,re.M)
+_LITERAL_LINE = re.compile(r'^([ \t]*)(\S(?:.*\S)?)',re.M)
+# characters that always need escaping, those the line start markup other
+# than enumerators starts with, and for each character an expression one of
+# which matches any newline terminated text _ESCAPE_CHECK matches, the first
+# line aside.  Searching for a single character, or an expression starting
+# with one, is much faster than searching for _ESCAPE_CHECK
+_ESCAPE_CHARS = '\\*`|_'
+_LINE_START_CHARS = ' \t!"#$%&\'()*+,-./:;<=>?@[\\]^_`{|}~\u2022\u2023\u2043'
+_LINE_START_NEEDLES = (('\n',re.compile('\n[%s]'%re.escape(_LINE_START_CHARS))),('.',re.compile(r'\.\s')),
+                       (')',re.compile(r'\)\s')),(':',re.compile(r':\s')))
+
+def _may_need_escape(text) :
+    # quick check of text ending with a newline before _ESCAPE_CHECK
+    for char in _ESCAPE_CHARS :
+        if char in text :
+            return True
+    if text[:1] and text[0] in _LINE_START_CHARS :
+        return True
+    for char, needle in _LINE_START_NEEDLES :
+        if char in text and needle.search(text) :
+            return True
+    return False
+
+ESCAPE_MODES = (None,'none','inline','literal')
+
+def _check_escape(escape) :
+    if escape not in ESCAPE_MODES :
+        raise ReStUtilException('Unknown escape mode %r, use one of %s'%(escape,ESCAPE_MODES))
+    return escape
+
+def _literal_line(match) :
+    indent, line = match.groups()
+    # an inline literal cannot hold `` or end with a backquote
+    if indent :
+        # an indented line starts a definition list or block quote
+        indent = '\\'+indent
+    if '``' in line or line.endswith('`') :
+        return indent+_escape_inline(line)
+    return indent+'``'+line+'``'
+
+def _escape_markup(match) :
+    # a backslash before a line of backslashes would only lengthen it, an
+    # escaped space, which docutils drops, does not
+    markup = match.group()
+    return ('\\ ' if markup[:1] == '\\' else '\\')+markup
+
+def _escape_inline(text) :
+    if _ESCAPE_CHECK.search(text) is None :
+        return text
+    text = _LITERAL_MARKER.sub(r'\\:',text.translate(_INLINE_ESCAPES))
+    return _LINE_START_MARKUP.sub(_escape_markup,text)
+
+def escape_text(text,mode='inline') :
+    '''return *text* escaped so it is rendered as is rather than read as
+    reStructuredText markup.  With *mode* ``'inline'`` the inline markup
+    characters ``\\ * ` | _`` are backslash escaped, as is the markup
+    docutils recognizes at the start of a line, such as comments, bullets,
+    enumerators, field and option lists, transitions and section adornments,
+    indentation and a ``::`` ending a line, with ``'literal'`` each line is
+    made an inline literal, and with ``'none'``
+    or None the text is returned as is.  Text without markup characters is
+    returned unchanged after a single regular expression search.'''
+    if mode is None or mode == 'none' :
+        return text
+    elif mode == 'inline' :
+        return _escape_inline(text)
+    elif mode == 'literal' :
+        return _LITERAL_LINE.sub(_literal_line,text)
+    raise ReStUtilException('Unknown escape mode %r, use one of %s'%(mode,ESCAPE_MODES))
+
+def _escape_column(column,mode) :
+    # escape a column of cell text, skipping the whole column with a single
+    # search if none of it needs inline escaping
+    if mode is None or mode == 'none' :
+        return column
+    elif mode == 'inline' :
+        text = '\n'.join(column)+'\n'
+        if not _may_need_escape(text) or _ESCAPE_CHECK.search(text) is None :
+            return column
+        return list(map(_escape_inline,column))
+    return [escape_text(x,mode) for x in column]
+
+def _uncached_width(text) :
+    # as docutils.utils.column_width, which the grid table parser uses
+    east_asian_width, combining = unicodedata.east_asian_width, unicodedata.combining
+    return sum([0 if combining(c) else 2 if east_asian_width(c) in 'WF' else 1 for c in text])
+
+_cached_width = functools.lru_cache(maxsize=65536)(_uncached_width)
+
+def _display_width(text) :
+    '''number of columns *text* takes in a grid table, wide and fullwidth
+    East Asian characters take two and combining characters none.  ASCII
+    text is measured with len(), the width of other strings is cached.'''
+    if text.isascii() :
+        return len(text)
+    return _cached_width(text)
+
+def _justify(just,text,width) :
+    # str.ljust, rjust or center to a display width
+    return just(text,width-_display_width(text)+len(text))
+
+def _lines_widths(cells) :
+    # display width of the widest line of each cell, a list of lines, with
+    # the lines of ASCII rows measured by len()
+    if all(map(str.isascii,itertools.chain.from_iterable(cells))) :
+        return [max([len(y) for y in x] or [0]) for x in cells]
+    return [max(map(_display_width,x),default=0) for x in cells]
+
+def _builds_from_parts(component) :
+    # components whose text is the join of their iter_parts(), rather than
+    # built by an overridden build_text()
+    cls = type(component)
+    return cls.build_text is ReStBase.build_text and cls.iter_parts is not ReStBase.iter_parts
+
+class ReStIndent(object) :
+    '''marker yielded by *iter_parts()* to indent the text of the parts that
+    follow it, e.g. a directive body::
+
+      def iter_parts(self) :
+          yield '.. note::\\n\\n'
+          yield ReStIndent()
+          yield self.body
+          yield ReStIndent.END
+
+    The render walk prefixes every non blank line with *prefix* as it is
+    emitted, so nested directives are indented in the same single pass over
+    their text.  Indents nest, and those still open are closed at the end of
+    the component's parts.  Indented parts should start at the beginning of
+    a line.'''
+
+    __slots__ = ('prefix',)
+
+    def __init__(self,prefix='   ') :
+        self.prefix = prefix
+
+    def __repr__(self) :
+        return 'ReStIndent.END' if self.prefix is None else 'ReStIndent(%r)'%self.prefix
+
+# closes the last indent opened by the component
+ReStIndent.END = ReStIndent(None)
+
+_INDENT_LINE = re.compile(r'\n(?=[^\n])')
+
+def _apply_indent(prefixes,marker,depth) :
+    # open or close an indent on the stack of cumulative prefixes of a render
+    # walk, a frame entered at depth does not close the indents of its parents
+    if marker.prefix is not None :
+        prefixes.append(prefixes[-1]+marker.prefix)
+    elif len(prefixes) > depth :
+        prefixes.pop()
+
+def _indent(chunk,prefix,line_start) :
+    # (lead, chunk) with every non blank line of chunk prefixed, lead is the
+    # prefix of the first line when the chunk starts one
+    lead = prefix if line_start and chunk[0] != '\n' else ''
+    if '\n\n' in chunk : # blank lines stay empty
+        chunk = _INDENT_LINE.sub(lambda m: '\n'+prefix,chunk)
+    elif chunk[-1] == '\n' : # all but the final newline
+        chunk = chunk.replace('\n','\n'+prefix,chunk.count('\n')-1)
+    else :
+        chunk = chunk.replace('\n','\n'+prefix)
+    return lead, chunk
+
+def _join_indented(parts) :
+    # the text of a component from its parts, strings, built child components
+    # and ReStIndent markers
+    prefixes, out, last = [''], [], '\n'
+    for p in parts :
+        if isinstance(p,ReStIndent) :
+            _apply_indent(prefixes,p,1)
+            continue
+        p = p if isinstance(p,str) else p.text
+        if p :
+            if len(prefixes) > 1 :
+                lead, p = _indent(p,prefixes[-1],last[-1] == '\n')
+                if lead :
+                    out.append(lead)
+            out.append(p)
+            last = p
+    return ''.join(out)
+
+def _iter_text(root) :
+    # the render walk, a stack of part iterators rather than nested
+    # generators, so the depth of the tree is not limited by the call stack
+    # and every chunk is yielded once, by this generator, whatever its depth.
+    # Frames are (parts, indent depth at entry), prefixes the indent stack
+    prefixes, last = [''], '\n'
+    stack = [(iter((root,)),1)]
+    while stack :
+        for part in stack[-1][0] :
+            if not isinstance(part,str) :
+                if isinstance(part,ReStIndent) :
+                    _apply_indent(prefixes,part,stack[-1][1])
+                    continue
+                if part._dirty :
+                    stack.append((iter(part.iter_parts()),len(prefixes)))
+                    break
+                part = part.text
+            if part :
+                if len(prefixes) > 1 :
+                    lead, part = _indent(part,prefixes[-1],last[-1] == '\n')
+                    if lead :
+                        yield lead
+                last = part
+            yield part
+        else :
+            del prefixes[stack.pop()[1]:]
+
+def _build_texts(root) :
+    # build the text of root and of every dirty component below it, children
+    # before their parents, joining the parts of each with the text of its
+    # children, without recursion.  Built components are marked clean as
+    # get_text() would
+    prof = ReStProfiler._active
+    stack = [(root,None,0,0.,False)]
+    while stack :
+        comp, parts, depth, start, indented = stack.pop()
+        if parts is None :
+            if not comp._dirty : # a shared component built already
+                continue
+            start = time.perf_counter() if prof is not None else 0.
+            parts = list(comp.iter_parts())
+            children = []
+            for part in parts :
+                if isinstance(part,str) :
+                    continue
+                elif isinstance(part,ReStIndent) :
+                    indented = True
+                    continue
+                elif not part._dirty :
+                    continue
+                elif _builds_from_parts(part) :
+                    children.append((part,None,depth+1,0.,False))
+                elif prof is not None :
+                    prof._depth += depth
+                    try :
+                        part.get_text()
+                    finally :
+                        prof._depth -= depth
+                else :
+                    part.get_text()
+            stack.append((comp,parts,depth,start,indented))
+            stack.extend(children)
+        else :
+            if indented :
+                text = _join_indented(parts)
+            else :
+                text = ''.join([p if isinstance(p,str) else p.text for p in parts])
+            object.__setattr__(comp,'text',text)
+            comp._dirty = False
+            if prof is not None and comp is not root :
+                prof._record(comp,time.perf_counter()-start,len(text),prof._depth+depth)
+
+class _ReStList(list) :
+    # a list member of a component, the components of a container or the
+    # rows of a table, whose changes in place mark the component dirty and
+    # link the components added to it
+    __slots__ = ('_owner',)
+
+    def __init__(self,owner,items=()) :
+        list.__init__(self,items)
+        self._owner = owner
+
+    def __reduce__(self) :
+        return (_ReStList,(self._owner,list(self)))
+
+    def _changed(self,added=()) :
+        self._owner._list_changed(added)
+
+    def append(self,item) :
+        list.append(self,item)
+        self._changed((item,))
+
+    def extend(self,items) :
+        items = list(items)
+        list.extend(self,items)
+        self._changed(items)
+
+    def insert(self,index,item) :
+        list.insert(self,index,item)
+        self._changed((item,))
+
+    def __setitem__(self,index,item) :
+        items = list(item) if isinstance(index,slice) else [item]
+        list.__setitem__(self,index,items if isinstance(index,slice) else item)
+        self._changed(items)
+
+    def __iadd__(self,items) :
+        self.extend(items)
+        return self
+
+    def __imul__(self,n) :
+        list.__imul__(self,n)
+        self._changed()
+        return self
+
+    def __delitem__(self,index) :
+        list.__delitem__(self,index)
+        self._changed()
+
+    def pop(self,*args) :
+        item = list.pop(self,*args)
+        self._changed()
+        return item
+
+    def remove(self,item) :
+        list.remove(self,item)
+        self._changed()
+
+    def clear(self) :
+        list.clear(self)
+        self._changed()
+
+    def sort(self,*args,**kwargs) :
+        list.sort(self,*args,**kwargs)
+        self._changed()
+
+    def reverse(self) :
+        list.reverse(self)
+        self._changed()
+
 class ReStBase(object) :
     '''Base reStructuredText component containing text, should be subclassed with
     *build_text* method overridden. Components are expected to add their own
-    newline character at the end of their text.'''
+    newline character at the end of their text.
+
+    The text built by *get_text()* is cached and only rebuilt after the
+    component, or one of its descendants, changes.  Assigning any public
+    attribute of a component marks it and its ancestors dirty, as does adding
+    to a container.  A container's *components* list, and a table's *data*
+    list of rows, may also be changed in place, the components added to
+    *components* are linked to the container.  Other members mutated in
+    place, e.g. the rows of a table, must be followed by a call to
+    *invalidate()*.
+
+    Components use __slots__ to keep large trees compact, subclasses should
+    call *ReStBase.__init__* and may declare their own __slots__.  Those
+    that do not, setting their own attributes only, start dirty and without
+    parents all the same.
+
+    Rendering walks the component tree with an explicit stack rather than
+    recursing through nested *get_text()* calls, so trees of any depth can be
+    rendered.  Components plug into the walk by overriding *iter_parts()*,
+    which yields the strings of their text and, in their place, the child
+    components whose text goes there.  Components that override
+    *build_text()* instead are rendered through *get_text()*.  See *walk()*
+    and ReStVisitor for other passes over a tree.'''
+
+    __slots__ = ('text','_dirty','_parents')
+
+    # render in an executor in aiter_text() when one is given
+    OFFLOAD = False
+
+    # members assigned a list are given a _ReStList, which tracks changes
+    _LISTS = ()
 
     def __init__(self,text='') :
-        self.text = text
+        object.__setattr__(self,'_dirty',True)
+        object.__setattr__(self,'_parents',None)
+        object.__setattr__(self,'text',text)
+
+    def __getattr__(self,name) :
+        # subclasses not calling ReStBase.__init__ start dirty without parents
+        if name == '_dirty' :
+            return True
+        elif name == '_parents' :
+            return None
+        raise AttributeError(name)
+
+    def __getstate__(self) :
+        # parents are left out so pickling a subtree does not pickle the tree
+        # it is part of, __setstate__ links the children back up instead
+        state = dict(getattr(self,'__dict__',{}))
+        for cls in type(self).__mro__ :
+            for name in cls.__dict__.get('__slots__',()) :
+                if name != '_parents' and hasattr(self,name) :
+                    state[name] = getattr(self,name)
+        return state
+
+    def __setstate__(self,state) :
+        # restore without __setattr__, which expects a complete object
+        object.__setattr__(self,'_parents',None)
+        for name, value in state.items() :
+            if type(value) is list and name in self._LISTS :
+                value = _ReStList(self,value)
+            object.__setattr__(self,name,value)
+        for child in self._children() :
+            self._adopt(child)
+
+    def _children(self) :
+        # components this component renders as part of its own text
+        return ()
+
+    def __setattr__(self,name,value) :
+        if type(value) is list and name in self._LISTS :
+            value = _ReStList(self,value)
+        object.__setattr__(self,name,value)
+        if name[0] != '_' :
+            # assigning text is a rebuild of this component, or an explicit
+            # replacement of it, either way only the ancestors are stale
+            if name != 'text' and not self._dirty :
+                object.__setattr__(self,'_dirty',True)
+            # components being built have no ancestors yet
+            if self._parents is not None :
+                self._invalidate_parents()
+
+    def invalidate(self) :
+        '''mark the cached text of the component and all of its ancestors as
+        stale, so they are rebuilt on the next *get_text()*'''
+        if not self._dirty :
+            object.__setattr__(self,'_dirty',True)
+        if self._parents is not None :
+            self._invalidate_parents()
+
+    def _list_changed(self,added) :
+        # a _ReStList member changed in place
+        self.invalidate()
+
+    def parents(self) :
+        'return a tuple of the containers the component has been added to'
+        parents = self._parents
+        if parents is None :
+            return ()
+        elif isinstance(parents,tuple) :
+            return parents
+        return (parents,)
+
+    def _invalidate_parents(self) :
+        # an ancestor that is already dirty has dirty ancestors too, so stop
+        # walking up there
+        stack = [p for p in self.parents() if not p._dirty]
+        while stack :
+            comp = stack.pop()
+            object.__setattr__(comp,'_dirty',True)
+            stack.extend(p for p in comp.parents() if not p._dirty)
+
+    def _adopt(self,component) :
+        # record self as a parent of component so changes to it propagate up.
+        # nearly every component has a single parent, which is stored as is
+        # rather than in a tuple to save memory
+        parents = component._parents
+        if parents is None :
+            object.__setattr__(component,'_parents',self)
+        else :
+            object.__setattr__(component,'_parents',component.parents()+(self,))
 
     def get_text(self) :
-        'return the reStructuredText string constructed for the object'
-        self.build_text()
+        '''return the reStructuredText string constructed for the object,
+        calling *build_text()* only if the component changed since the last
+        call'''
+        if self._dirty :
+            if ReStProfiler._active is None :
+                self.build_text()
+            else :
+                ReStProfiler._active._build(self)
+            self._dirty = False
         return self.text
 
     def build_text(self) :
-        '''builds the text of the component, called by *get_text()*.  default
-        method does nothing, should be overridden in subclasses.
+        '''builds the text of the component, called by *get_text()*.  The
+        default joins the parts from *iter_parts()*, building the text of the
+        dirty components among them the same way, and does nothing for
+        components that hold literal text.  Subclasses may override it
+        instead of *iter_parts()*.
         '''
-        pass
+        if type(self).iter_parts is not ReStBase.iter_parts :
+            _build_texts(self)
+
+    def iter_parts(self) :
+        '''generator yielding the parts of the text of the component in order,
+        each either a string or a child component whose text goes in its
+        place, or a ReStIndent marker indenting the parts after it.
+        Subclasses override this to plug into rendering, the default yields
+        the result of *get_text()*.'''
+        yield self.get_text()
+
+    def iter_text(self) :
+        '''generator yielding the reStructuredText for the object in chunks, in
+        order, without building the complete text.  The parts of each
+        component are walked with an explicit stack, reusing the cached text
+        of components that are current, so each chunk is produced once
+        whatever the depth of the tree.  Streaming does not cache anything,
+        only *get_text()* does.'''
+        if ReStProfiler._active is not None :
+            return ReStProfiler._active._iter_text(self)
+        return _iter_text(self)
+
+    def walk(self) :
+        '''generator yielding (component, depth) for the component, at depth 0,
+        and all of its descendants in document order, e.g.::
+
+          >>> titles = [c.title for c,d in doc.walk() if isinstance(c,ReStSection)]
+
+        The walk uses an explicit stack, so it works at any depth, and does
+        not render anything.'''
+        stack = [iter((self,))]
+        while stack :
+            for component in stack[-1] :
+                yield component, len(stack)-1
+                children = component._children()
+                if children :
+                    stack.append(iter(children))
+                    break
+            else :
+                stack.pop()
+
+    def render_to(self,f) :
+        '''write the reStructuredText for the object to the file-like object *f*
+        chunk by chunk as produced by *iter_text()*, so the complete text is
+        never held in memory at once'''
+        write = f.write
+        for chunk in self.iter_text() :
+            write(chunk)
+
+    async def aiter_text(self,executor=None) :
+        '''asynchronous generator yielding the same chunks as *iter_text()*,
+        returning control to the event loop after each component.  Components
+        with *OFFLOAD* set, the tables, are rendered in *executor* if one is
+        given, in batches of chunks so they never block the event loop for
+        long.  While a ReStProfiler is active the chunks come from the
+        profiled *iter_text()* instead.'''
+        if ReStProfiler._active is not None :
+            for chunk in self.iter_text() :
+                yield chunk
+            return
+        prefixes, last = [''], '\n'
+        stack = [(iter((self,)),1)]
+        while stack :
+            for part in stack[-1][0] :
+                if not isinstance(part,str) :
+                    if isinstance(part,ReStIndent) :
+                        _apply_indent(prefixes,part,stack[-1][1])
+                        continue
+                    if isinstance(part,ReStReservation) and not part._filled :
+                        # wait without blocking the loop, which may be
+                        # filling the reservation
+                        await asyncio.get_running_loop().run_in_executor(None,part.wait)
+                    if part._dirty and executor is not None and part.OFFLOAD :
+                        async for chunk in _aiter_in_executor(_iter_text(part),executor) :
+                            if chunk and len(prefixes) > 1 :
+                                lead, chunk = _indent(chunk,prefixes[-1],last[-1] == '\n')
+                                if lead :
+                                    yield lead
+                            if chunk :
+                                last = chunk
+                            yield chunk
+                        continue
+                    if part._dirty :
+                        stack.append((iter(part.iter_parts()),len(prefixes)))
+                        break
+                    part = part.text
+                if part :
+                    if len(prefixes) > 1 :
+                        lead, part = _indent(part,prefixes[-1],last[-1] == '\n')
+                        if lead :
+                            yield lead
+                    last = part
+                yield part
+            else :
+                del prefixes[stack.pop()[1]:]
+                await asyncio.sleep(0)
+
+    async def arender_to(self,stream,executor=None,encoding=None,buffer_size=65536) :
+        '''asynchronously write the reStructuredText for the object to
+        *stream*, which may be an asyncio StreamWriter, an object with a
+        coroutine *write()* method such as an aiofiles file, or a regular
+        file-like object.  Chunks from *aiter_text()* are written in blocks of
+        about *buffer_size* characters, awaiting *drain()* after each one if
+        the stream has it.  Text is encoded with *encoding* before writing,
+        which defaults to utf-8 for StreamWriters that only accept bytes.
+        Writes to a regular file are made in *executor* if one is given.'''
+        if encoding is None and isinstance(stream,asyncio.StreamWriter) :
+            encoding = 'utf-8'
+        buf, size = [], 0
+        async for chunk in self.aiter_text(executor) :
+            buf.append(chunk)
+            size += len(chunk)
+            if size >= buffer_size :
+                await _awrite(stream,''.join(buf),encoding,executor)
+                buf, size = [], 0
+        if buf :
+            await _awrite(stream,''.join(buf),encoding,executor)
 
     def __add__(self,obj) :
         if isinstance(obj,str) :
@@ -43,19 +786,41 @@ class ReStBase(object) :
 
 class ReStContainer(ReStBase) :
     '''A container for holding multiple ReSt* objects. Useful for organizing
-    document elements.  Individual components are separated with newlines.'''
-    
+    document elements.  Individual components are separated with newlines.
+    Components are added with *add()*, or by changing the *components*
+    list in place, e.g. with *components.append()*, either way the
+    container is recorded as their parent and marked dirty.  *components*
+    is a copy of the list given to the constructor or assigned.'''
+
+    __slots__ = ('components',)
+
+    _LISTS = ('components',)
+
     def __init__(self,components=None) :
+        ReStBase.__init__(self)
         self.components = components or []
-
-    def build_text(self) :
-        '''concatenates *get_text()* result for all objects in instance field
-        *components* in order'''
-        self.text = "\n"+''.join([x.get_text()+'\n' for x in self.components])
+        for component in self.components :
+            self._adopt(component)
+
+    def _children(self) :
+        return self.components
+
+    def _list_changed(self,added) :
+        for component in added :
+            if isinstance(component,ReStBase) :
+                self._adopt(component)
+        self.invalidate()
+
+    def iter_parts(self) :
+        '''yields the objects in *components* in order, each followed by a
+        newline'''
+        yield '\n'
+        for x in self.components :
+            yield x
+            yield '\n'
 
     def __add__(self,obj) :
         self.add(obj)
-        self.build_text()
         return self
 
     def add(self,component,*args) :
@@ -64,11 +829,14 @@ class ReStContainer(ReStBase) :
         is wrapped in a ReStText object for maximal convenience'''
 
         comps_to_add = [component]+list(args)
-        for component in comps_to_add :
-            # convenience case, adding a string wraps string in ReStText object
-            if isinstance(component,str) :
-                component = ReStText(component)
-            self.components.append(component)
+        with _ADD_LOCK :
+            for component in comps_to_add :
+                # convenience case, adding a string wraps string in ReStText object
+                if isinstance(component,str) :
+                    component = ReStText(component)
+                list.append(self.components,component)
+                self._adopt(component)
+            self.invalidate()
 
 
 class ReStSection(ReStContainer) :
@@ -78,16 +846,23 @@ class ReStSection(ReStContainer) :
 
     SECTION_LEVELS = '=-~:#+'
 
+    __slots__ = ('title','level')
+
     def __init__(self,title,level=None) :
         ReStContainer.__init__(self)
         self.title = title
         self.level = level or 1
-        self.components = [None]
 
-    def build_text(self) :
+    def header_text(self) :
+        'return the title and its underline, followed by a newline'
         char = ReStSection.SECTION_LEVELS[self.level-1 if self.level is not None else 0]
-        self.components[0] = ReStBase(self.title+'\n'+char*len(self.title)+'\n')
-        ReStContainer.build_text(self)
+        return self.title+'\n'+char*len(self.title)+'\n'
+
+    def iter_parts(self) :
+        yield '\n'
+        yield self.header_text()
+        for part in ReStContainer.iter_parts(self) :
+            yield part
 
     def add(self,component,*args) :
         '''Overloaded method that increments other ReStSection components so
@@ -107,71 +882,1035 @@ class ReStSection(ReStContainer) :
              
              >>> print sec
         '''
-        if isinstance(component,ReStSection) :
-            component.level = self.level+1
-        ReStContainer.add(self,component,*args)
+        with _ADD_LOCK :
+            if isinstance(component,ReStSection) :
+                component.level = self.level+1
+            ReStContainer.add(self,component,*args)
+
+
+def _file_hash(fn,block_size=1<<20) :
+    # sha256 hex digest of the file contents, None if there is no file
+    digest = hashlib.sha256()
+    try :
+        f = open(fn,'rb')
+    except FileNotFoundError :
+        return None
+    with f :
+        for block in iter(lambda: f.read(block_size),b'') :
+            digest.update(block)
+    return digest.hexdigest()
+
+def _umask() :
+    umask = os.umask(0)
+    os.umask(umask)
+    return umask
+
+class _AtomicFile(object) :
+    # text written utf-8 encoded to a temporary file next to path, which
+    # replaces path on close() only if the content differs, so unchanged
+    # files keep their modification time
+    def __init__(self,path) :
+        self.path = path
+        fd, self.tmp_path = tempfile.mkstemp(prefix='.'+os.path.basename(path)+'.',suffix='.tmp',
+                                             dir=os.path.dirname(os.path.abspath(path)))
+        self.f = os.fdopen(fd,'wb')
+        self.digest = hashlib.sha256()
+
+    def write(self,text) :
+        # returns the encoded data, for callers hashing parts of the file.
+        # text may be encoded already
+        data = text.encode('utf-8') if isinstance(text,str) else text
+        self.digest.update(data)
+        self.f.write(data)
+        return data
+
+    def close(self) :
+        # returns True if path was replaced
+        self.f.close()
+        if _file_hash(self.path) == self.digest.hexdigest() :
+            os.remove(self.tmp_path)
+            return False
+        # mkstemp files are private, give the file the mode it had or would
+        # have had if opened normally
+        if os.path.exists(self.path) :
+            os.chmod(self.tmp_path,os.stat(self.path).st_mode & 0o7777)
+        else :
+            os.chmod(self.tmp_path,0o666 & ~_umask())
+        os.replace(self.tmp_path,self.path)
+        return True
+
+    def discard(self) :
+        self.f.close()
+        if os.path.exists(self.tmp_path) :
+            os.remove(self.tmp_path)
+
+def _table_of(table) :
+    # the ReStSimpleTable of a ReStTable or ReStSimpleTable
+    return table._simp_table if isinstance(table,ReStTable) else table
+
+def _num_rows(table) :
+    # number of data rows of a table, None for streamed data
+    data = _table_of(table).data
+    if isinstance(data,dict) :
+        return len(next(iter(data.values()),()))
+    elif hasattr(data,'__len__') :
+        return len(data)
+    return None
+
+class _CountedRows(object) :
+    # iterator over streamed table rows counting those read
+    def __init__(self,rows) :
+        self.rows = iter(rows)
+        self.count = 0
+
+    def __iter__(self) :
+        return self
+
+    def __next__(self) :
+        row = next(self.rows)
+        self.count += 1
+        return row
+
+class _ShardOut(object) :
+    # text of a component being sharded, buffered until it is known to need a
+    # file of its own.  Only the main file output may not get one
+    __slots__ = ('buf','size','f','main')
+
+    def __init__(self,main=False) :
+        self.buf, self.size, self.f, self.main = [], 0, None, main
+
+class _ShardInclude(str) :
+    # file name of a shard to include, in a buffer that may end up in the
+    # main file or in a shard, which include it by different paths
+    __slots__ = ()
+
+class _Sharder(object) :
+    '''renders top level components for ReStDocument.write_sharded, writing
+    the sections and tables selected by the policy to files of their own and
+    returning the text for the main file with includes in their place'''
+
+    def __init__(self,shard_dir,include_dir,stem,max_bytes,max_rows,section_level,buffer_size=65536) :
+        self.shard_dir = shard_dir
+        self.include_dir = include_dir
+        self.stem = stem
+        self.max_bytes = max_bytes
+        self.max_rows = max_rows
+        self.section_level = section_level
+        self.buffer_size = buffer_size
+
+    def __call__(self,component,index) :
+        # returns (main file text, shard paths) for the component, the k-th
+        # shard of the component is named <stem>_<index>_<k>.rst.  Each call
+        # renders with a copy, so threads can share the sharder
+        return copy.copy(self)._render(component,index)
+
+    def _render(self,component,index) :
+        self.index, self.shards, self.open_files = index, [], []
+        main = _ShardOut(main=True)
+        # frames are (parts, output, whether the output is the frame's own)
+        stack = [(iter((component,)),main,False)]
+        try :
+            while stack :
+                parts, out = stack[-1][:2]
+                for part in parts :
+                    if isinstance(part,str) :
+                        self._add(out,[part],len(part))
+                        continue
+                    is_table = isinstance(part,(ReStTable,ReStSimpleTable))
+                    own = is_table or isinstance(part,ReStSection)
+                    part_out = _ShardOut() if own else out
+                    if own and self._forced(part,is_table) :
+                        self._open(part_out)
+                    counted = self._count_rows(part) if is_table else None
+                    if is_table or not isinstance(part,ReStContainer) :
+                        for chunk in part.iter_text() :
+                            self._add(part_out,[chunk],len(chunk))
+                            # streamed rows are known to be too many once read
+                            if counted is not None and part_out.f is None and counted.count > self.max_rows :
+                                self._open(part_out)
+                        if own :
+                            self._finish(part_out,out)
+                    else :
+                        stack.append((iter(part.iter_parts()),part_out,own))
+                        break
+                else :
+                    parts, out, own = stack.pop()
+                    if own :
+                        self._finish(out,stack[-1][1])
+        except BaseException :
+            for f in self.open_files :
+                f.discard()
+            raise
+        return self._join(main.buf,True), self.shards
+
+    def _forced(self,component,is_table) :
+        if is_table :
+            if self.max_rows is None :
+                return False
+            rows = _num_rows(component)
+            if rows is None : # streamed, see _count_rows, unless already read
+                return _table_of(component).data is None
+            return rows > self.max_rows
+        return self.section_level is not None and component.level == self.section_level
+
+    def _count_rows(self,table) :
+        # count the rows of a streamed table as rendering reads them, returns
+        # the counter or None
+        simp_table = _table_of(table)
+        if self.max_rows is None or simp_table.data is None or _num_rows(table) is not None :
+            return None
+        counted = _CountedRows(simp_table.data)
+        object.__setattr__(simp_table,'data',counted)
+        return counted
+
+    def _open(self,out) :
+        path = os.path.join(self.shard_dir,'%s_%d_%d.rst'%(self.stem,self.index,len(self.shards)+1))
+        self.shards.append(path)
+        out.f = _AtomicFile(path)
+        self.open_files.append(out.f)
+
+    def _add(self,out,chunks,size) :
+        out.buf.extend(chunks)
+        out.size += size
+        if out.f is None :
+            if out.main or self.max_bytes is None or out.size <= self.max_bytes :
+                return
+            self._open(out)
+        if out.size >= self.buffer_size :
+            out.f.write(self._join(out.buf,False))
+            out.buf, out.size = [], 0
+
+    def _finish(self,out,parent) :
+        if out.f is None :
+            # small enough to stay in the file including it
+            self._add(parent,out.buf,out.size)
+            return
+        out.f.write(self._join(out.buf,False))
+        f, out.f = out.f, None
+        f.close()
+        self.open_files.remove(f)
+        include = ReStInclude(os.path.basename(f.path)).get_text()
+        if self.include_dir :
+            self._add(parent,[_ShardInclude(os.path.basename(f.path))],len(include))
+        else :
+            self._add(parent,[include],len(include))
+
+    def _join(self,buf,main) :
+        # shards are all in one directory, the main file includes them from
+        # include_dir
+        if self.include_dir :
+            include_dir = self.include_dir if main else ''
+            buf = [ReStInclude(os.path.join(include_dir,x)).get_text()
+                   if isinstance(x,_ShardInclude) else x for x in buf]
+        return ''.join(buf)
+
+class _ReStTitle(ReStBase) :
+    # document title or subtitle, a title over and underlined with char
+    __slots__ = ('title','char')
+
+    def __init__(self,title,char) :
+        ReStBase.__init__(self)
+        self.title = title
+        self.char = char
+
+    def iter_parts(self) :
+        yield self.char*len(self.title)+'\n'+self.title+'\n'+self.char*len(self.title)
+
+
+def _target_name(name) :
+    # normalized reference name, case and whitespace do not matter
+    return ' '.join(name.lower().split())
+
+# inline literals, which are skipped, inline internal targets, phrase
+# references and simple references in reStructuredText source
+_REFERENCE = re.compile(r'``.+?``'
+                        r'|_`([^`]+)`'
+                        r'|(?<![\w`])`([^`]+)`(__?)(?!\w)'
+                        r'|(?<![\w`|])([^\W_]+(?:[-_.:+][^\W_]+)*)(__?)(?!\w)',re.S)
+_EMBEDDED = re.compile(r'(.*?)\s*<([^<>]+)>\Z',re.S)
+_EXPLICIT_TARGET = re.compile(r'^\.\. _([^:`]+|`[^`]+`):',re.M)
+
+def _iter_targets(root) :
+    # yield (target name, component, container) for the section and title
+    # implicit targets and hyperlink targets in root and its descendants in
+    # document order, container holding the component
+    stack = [(root,None)]
+    while stack :
+        component, container = stack.pop()
+        if isinstance(component,ReStHyperlink) :
+            yield _target_name(component.name.strip('`')), component, container
+        elif isinstance(component,_ReStSpilled) :
+            for name, target in component._targets :
+                yield name, target, component
+        elif isinstance(component,(ReStSection,_ReStTitle)) :
+            yield _target_name(component.title), component, container
+        children = component._children()
+        stack.extend((child,component) for child in reversed(children))
+
+def _index_target(targets,name,component) :
+    '''add a target to the index of name -> component, returns 'new', or
+    'duplicate' for a hyperlink with the same name and URL as one indexed,
+    which can be dropped, or 'conflict' for one with a different URL.
+    Several sections with the same title make the name ambiguous, the
+    component is then None.  Hyperlinks override sections, as in
+    docutils.'''
+    other = targets.get(name,False)
+    if other is component :
+        return 'duplicate' if isinstance(component,ReStHyperlink) else 'new'
+    elif other is False :
+        targets[name] = component
+    elif not isinstance(component,ReStHyperlink) :
+        if not isinstance(other,ReStHyperlink) :
+            targets[name] = None
+    elif isinstance(other,ReStHyperlink) :
+        if (other.url,other.indirect) == (component.url,component.indirect) :
+            return 'duplicate'
+        return 'conflict'
+    else :
+        targets[name] = component
+    return 'new'
+
+class ReStReservation(ReStContainer) :
+    '''A place in a ReStDocument, returned by *ReStDocument.reserve()*, to be
+    filled later, possibly from another thread.  Components are added to it
+    as to a container, then *done()* marks it complete, or *fail()* if it
+    could not be filled.  Used as a context manager it calls one or the
+    other on exit, e.g.::
+
+      >>> def build(slot,source) :
+      ...     with slot :
+      ...         slot.add(make_section(source))
+      >>> with ThreadPoolExecutor(4) as pool :
+      ...     for source in sources :
+      ...         pool.submit(build,doc.reserve(),source)
+      ...     doc.write()
+
+    The components are rendered in place of the reservation as if added to
+    the document there, rendering waits until it is done, so the document
+    is written in reservation order whichever finishes first, each part as
+    soon as it and everything before it is complete.'''
+
+    __slots__ = ('_filled','_error')
+
+    def __init__(self) :
+        ReStContainer.__init__(self)
+        self._filled = False
+        self._error = None
+
+    def __enter__(self) :
+        return self
+
+    def __exit__(self,exc_type,exc,tb) :
+        if exc is None :
+            self.done()
+        else :
+            self.fail(exc)
+        return False
+
+    def done(self) :
+        '''mark the reservation complete, rendering the document past it
+        resumes'''
+        with _FILLED :
+            self._filled = True
+            try :
+                for document in self.parents() :
+                    if isinstance(document,ReStDocument) :
+                        document._index_ready()
+            finally :
+                _FILLED.notify_all()
+
+    def fail(self,error) :
+        '''mark the reservation as failed with the exception *error*, which
+        rendering it then raises as a ReStUtilException'''
+        with _FILLED :
+            self._error = error
+        self.done()
+
+    def wait(self,timeout=None) :
+        '''block until the reservation is done, or *timeout* seconds have
+        passed, returns whether it is done'''
+        with _FILLED :
+            return _FILLED.wait_for(lambda: self._filled,timeout)
+
+    def iter_parts(self) :
+        self.wait()
+        if isinstance(self._error,ReStUtilException) :
+            raise self._error
+        elif self._error is not None :
+            raise ReStUtilException('Reserved part of the document failed: %r'%(self._error,))
+        # the document separates the components with newlines, as it does
+        # its own
+        for i, component in enumerate(self.components) :
+            if i :
+                yield '\n'
+            yield component
+
+
+def _scan_references(texts,targets,owner=None) :
+    '''return a list of (name, component) for the references in the source
+    of the ReStText *texts*, adding the targets they define to *targets*,
+    component being the text or *owner*'''
+    references = []
+    for text in texts :
+        if text.escape not in (None,'none') :
+            continue # escaped text holds no references
+        component = text if owner is None else owner
+        for match in _EXPLICIT_TARGET.finditer(text.source) :
+            targets.setdefault(_target_name(match.group(1).strip('`')),component)
+        for match in _REFERENCE.finditer(text.source) :
+            inline, phrase, phrase_kind, name, kind = match.groups()
+            if inline is not None :
+                targets.setdefault(_target_name(inline),component)
+            elif phrase is not None and phrase_kind == '_' :
+                embedded = _EMBEDDED.match(phrase)
+                if embedded is None :
+                    references.append((phrase,component))
+                elif embedded.group(2).endswith('_') and not embedded.group(2).endswith('\\_') :
+                    references.append((embedded.group(2)[:-1],component))
+                else :
+                    # an embedded URI defines a target named by the text
+                    targets.setdefault(_target_name(embedded.group(1)),component)
+            elif name is not None and kind == '_' :
+                references.append((name,component))
+    return references
+
+def _memory_estimate(component) :
+    # rough number of bytes held by component and its descendants, from the
+    # length of their strings and a sample of the rows of their tables
+    size = 0
+    for comp, depth in component.walk() :
+        size += 64
+        for name in ('text','source','title') :
+            value = getattr(comp,name,None)
+            if isinstance(value,str) :
+                size += len(value)
+        if isinstance(comp,ReStSimpleTable) :
+            num_rows = _num_rows(comp)
+            data = comp.data
+            if isinstance(data,dict) :
+                size += num_rows*len(data)*32
+            elif num_rows and isinstance(data,(list,tuple)) :
+                sample = data[:100]
+                sample_size = sum(sys.getsizeof(row)+sum(sys.getsizeof(c) for c in row)
+                                  for row in sample)
+                size += sample_size*num_rows//len(sample)
+            elif num_rows :
+                size += num_rows*64
+    return size
+
+class _SpillFile(object) :
+    # temporary file holding the utf-8 text of the components a document
+    # spilled, appended to and read back at given offsets from any thread
+    def __init__(self,directory=None) :
+        self.f = tempfile.TemporaryFile(dir=directory)
+        self.lock = threading.Lock()
+
+    def append(self,component) :
+        # render component to the end of the file, returns (offset, length)
+        with self.lock :
+            f = self.f
+            f.seek(0,os.SEEK_END)
+            offset = f.tell()
+            for chunk in component.iter_text() :
+                f.write(chunk.encode('utf-8'))
+            return offset, f.tell()-offset
+
+    def iter_bytes(self,offset,length,block_size=1<<20) :
+        while length > 0 :
+            with self.lock :
+                self.f.seek(offset)
+                data = self.f.read(min(block_size,length))
+            if not data :
+                raise ReStUtilException('Spill file is truncated')
+            offset += len(data)
+            length -= len(data)
+            yield data
+
+    def copy_to(self,f,offset,length) :
+        # copy to the text file f, kernel to kernel if both are utf-8 files,
+        # otherwise in blocks
+        if sys.platform.startswith('linux') and hasattr(os,'sendfile') :
+            try :
+                out_fd = f.fileno()
+                utf8 = codecs.lookup(f.encoding).name == 'utf-8'
+            except (AttributeError,TypeError,LookupError,OSError,io.UnsupportedOperation) :
+                utf8 = False
+            if utf8 :
+                f.flush()
+                with self.lock :
+                    self.f.flush()
+                    in_fd = self.f.fileno()
+                    sent = 0
+                    while sent < length :
+                        try :
+                            n = os.sendfile(out_fd,in_fd,offset+sent,length-sent)
+                        except OSError :
+                            if sent :
+                                raise
+                            break # not supported for these files
+                        if n == 0 :
+                            raise ReStUtilException('Spill file is truncated')
+                        sent += n
+                    if sent == length :
+                        return
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for data in self.iter_bytes(offset,length) :
+            f.write(decoder.decode(data))
+
+    def close(self) :
+        self.f.close()
+
+class _ReStSpilled(ReStBase) :
+    # in place of a finished top level component of a document with a memory
+    # budget, its text in the document's spill file.  The hyperlink targets
+    # and references of the component are kept for ReStDocument's index
+    __slots__ = ('title','_spill','_offset','_length','_targets','_text_targets','_references')
+
+    def __init__(self,component,spill) :
+        ReStBase.__init__(self)
+        self.title = getattr(component,'title',None)
+        self._spill = spill
+        self._offset, self._length = spill.append(component)
+
+        # small copies of the targets, which do not hold on to the tree
+        self._targets = []
+        for name, target, container in _iter_targets(component) :
+            if isinstance(target,ReStHyperlink) :
+                copy_ = ReStHyperlink(target.name,target.url,target.indirect)
+            else :
+                copy_ = _ReStTitle(target.title,'')
+            self._targets.append((name,copy_))
+        text_targets = {}
+        texts = [c for c,d in component.walk() if isinstance(c,ReStText)]
+        self._references = [name for name, c in _scan_references(texts,text_targets,self)]
+        self._text_targets = list(text_targets)
+
+    def iter_bytes(self) :
+        return self._spill.iter_bytes(self._offset,self._length)
+
+    def copy_to(self,f) :
+        self._spill.copy_to(f,self._offset,self._length)
+
+    def iter_parts(self) :
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for data in self.iter_bytes() :
+            yield decoder.decode(data)
+
+
+def _render_component(component,index=None) :
+    return component.get_text()
+
+def _has_csv_file(component) :
+    # whether a ReStTable in component writes a csv file, the path of which
+    # depends on the document, which worker processes do not have
+    return any(isinstance(c,ReStTable) and c.csv_file is not None for c, depth in component.walk())
+
+def _render_serialized(data,render,index) :
+    # runs in a worker process
+    return render(deserialize(data),index)
 
 
 class ReStDocument(ReStContainer) :
     '''Basic Document class, used to collect reStructuredText classes to produce a
     single output file.  Add a component by appending to the *components* member,
-    alternatively use the .add() method. Constructor accepts either a file-like 
-    object or a filename.'''
-
-    def __init__(self,f,title=None,subtitle=None) :
+    alternatively use the .add() method, which also indexes their hyperlink
+    targets and drops duplicate hyperlinks. Constructor accepts either a
+    file-like object or a filename.
+
+    With *skip_unchanged* True, *f* must be a filename, which is not opened
+    until the document is written.  *write()* then renders the document to a
+    temporary file next to it, hashing the output as it goes, and only
+    replaces the file, with an atomic rename, if its content differs, so an
+    unchanged file keeps its modification time.  Each write replaces the
+    whole file.  The output is encoded as utf-8.  After a write
+    *content_hash* is the sha256 hex digest of the output and
+    *section_hashes* those of the top level components.
+
+    The document keeps an index of its hyperlink targets, see *targets*,
+    filled in as components are added.  Adding a ReStHyperlink, on its own
+    or within a container, with the same name and URL as one already in the
+    document drops it, so generators need not track the links they made, one
+    with the same name and a different URL raises a ReStUtilException.
+    *check_references()* checks the references in the text against the
+    index without docutils.
+
+    Components may be added from several threads.  To assemble a document
+    concurrently in a deterministic order, reserve its parts in order with
+    *reserve()* and fill them in any order, see ReStReservation.
+
+    With a *memory_budget*, in bytes, the top level components that are
+    finished, i.e. have another one added after them and no pending
+    reservation before them, are rendered to a temporary file in
+    *spill_dir* and dropped once their estimated size exceeds the budget,
+    which keeps the memory used by a large report flat as it is built.
+    Writes copy the spilled text to the output file, kernel to kernel with
+    *os.sendfile()* where possible.  Finished components must then not be
+    changed, changes to those already spilled are lost.'''
+
+    __slots__ = ('_f','_fn','_content_hash','_section_hashes','_targets','_unindexed',
+                 '_memory_budget','_spill_dir','_spill','_checked','_held')
+
+    def __init__(self,f,title=None,subtitle=None,skip_unchanged=False,memory_budget=None,spill_dir=None) :
         components = []
         if title is not None :
-            components.append(ReStBase('='*len(title)+'\n'+title+'\n'+'='*len(title)))
+            components.append(_ReStTitle(title,'='))
         if subtitle is not None :
-            components.append(ReStBase('-'*len(subtitle)+'\n'+subtitle+'\n'+'-'*len(subtitle)))
+            components.append(_ReStTitle(subtitle,'-'))
         ReStContainer.__init__(self,components=components)
-
+        self._fn = None
+        self._content_hash = None
+        self._section_hashes = None
+        self._targets = {}
+        self._unindexed = collections.deque()
+        for component in components :
+            self._index_targets(component)
+        self._memory_budget = memory_budget
+        self._spill_dir = spill_dir
+        self._spill = None
+        self._checked = 0
+        self._held = []
+
+        if skip_unchanged :
+            if not isinstance(f,str) :
+                raise ReStUtilException('ReStDocument needs a filename to skip unchanged writes')
+            self._f = None
+            self._fn = f
         # check for file-like object
-        if hasattr(f,'write') :
+        elif hasattr(f,'write') :
             self._f = f
         # check for filename
         elif isinstance(f,str) or isinstance(f,unicode) :
             self._f = open(f,'w')
+            self._fn = f
         else :
             raise ReStUtilException('Unrecognized parameter format to ReStDocument, \
                                      must either have a .write(str) method or be a \
                                      filename')
 
-    def write(self) :
+    def add(self,component,*args) :
+        '''Add the components to the end of the document as
+        *ReStContainer.add()* does, indexing their hyperlink targets and
+        dropping the hyperlinks already in the document.'''
+        comps_to_add = []
+        with _ADD_LOCK :
+            for component in (component,)+args :
+                if isinstance(component,str) :
+                    component = ReStText(component)
+                # behind a pending reservation the targets are indexed in
+                # document order once it is done
+                if self._unindexed :
+                    self._unindexed.append(component)
+                    comps_to_add.append(component)
+                elif self._index_targets(component) :
+                    comps_to_add.append(component)
+            if comps_to_add :
+                ReStContainer.add(self,*comps_to_add)
+                self._spill_finished()
+
+    def reserve(self) :
+        '''add a ReStReservation to the end of the document and return it,
+        its place in the document is kept while it is filled, e.g. by a
+        worker thread.  The hyperlink targets in it are indexed once it and
+        all the reservations before it are done, so duplicates are dropped
+        in document order.'''
+        reservation = ReStReservation()
+        with _ADD_LOCK :
+            ReStContainer.add(self,reservation)
+            self._unindexed.append(reservation)
+            self._spill_finished()
+        return reservation
+
+    def wait(self,timeout=None) :
+        '''block until all the reservations of the document are done, or
+        *timeout* seconds have passed, returns whether they are done.
+        Rendering need not wait for them all, it waits for each in turn.'''
+        with _FILLED :
+            return _FILLED.wait_for(lambda: not self._unindexed,timeout)
+
+    def _index_ready(self) :
+        # index the components at the front of the document that were
+        # waiting on reservations, up to the next one not done
+        unindexed = self._unindexed
+        while unindexed :
+            component = unindexed[0]
+            if isinstance(component,ReStReservation) and not component._filled :
+                break
+            unindexed.popleft()
+            try :
+                indexed = self._index_targets(component)
+            except ReStUtilException as e :
+                # a conflicting hyperlink fails the part of the document
+                # it is in, which rendering then raises, rather than done()
+                if not isinstance(component,ReStReservation) :
+                    failed = ReStReservation()
+                    failed._filled = True
+                    self.components = [failed if c is component else c for c in self.components]
+                    self._adopt(failed)
+                    component = failed
+                component._error = e
+                continue
+            if not indexed :
+                self.components = [c for c in self.components if c is not component]
+        self._spill_finished()
+
+    def _spill_finished(self) :
+        # add the newly finished top level components to the ones held in
+        # memory, spilling them all once they are over the budget
+        if self._memory_budget is None :
+            return
+        components = self.components
+        while self._checked < len(components)-1 :
+            component = components[self._checked]
+            if self._unindexed and component is self._unindexed[0] :
+                break
+            if not isinstance(component,_ReStSpilled) :
+                self._held.append((self._checked,_memory_estimate(component)))
+            self._checked += 1
+        if sum(size for index, size in self._held) <= self._memory_budget :
+            return
+
+        if self._spill is None :
+            self._spill = _SpillFile(self._spill_dir)
+        for index, size in self._held :
+            component = components[index]
+            originals = [target for name, target, container in _iter_targets(component)]
+            spilled = _ReStSpilled(component,self._spill)
+            # the index keeps the copies of the targets, not the tree
+            for (name,target), original in zip(spilled._targets,originals) :
+                if self._targets.get(name) is original :
+                    self._targets[name] = target
+            components[index] = spilled
+        self._held = []
+        self.invalidate()
+
+    def _index_targets(self,component) :
+        # index the targets of component, dropping duplicate hyperlinks from
+        # their containers, returns False if component itself is dropped.
+        # nothing is indexed if any hyperlink conflicts
+        # the new targets are looked up in both, and only stored in
+        # self._targets once none conflicts
+        added = {}
+        targets = collections.ChainMap(added,self._targets)
+        duplicates = collections.defaultdict(list)
+        for name, target, container in _iter_targets(component) :
+            status = _index_target(targets,name,target)
+            if status == 'conflict' :
+                raise ReStUtilException('Hyperlink target %r already defined with a different URL: %r'%
+                                        (target.name,targets[name].url))
+            elif status == 'duplicate' :
+                duplicates[container].append(target)
+        self._targets.update(added)
+        if None in duplicates :
+            return False
+        for container, dropped in duplicates.items() :
+            # the last occurrences, in case the same link is there twice
+            dropped = collections.Counter(map(id,dropped))
+            components = []
+            for child in reversed(container.components) :
+                if dropped[id(child)] :
+                    dropped[id(child)] -= 1
+                else :
+                    components.append(child)
+            components.reverse()
+            container.components = components
+        return True
+
+    @property
+    def targets(self) :
+        '''dict of the hyperlink targets of the components added to the
+        document, the normalized reference name, lowercase with single
+        spaces, mapped to the ReStHyperlink, ReStSection or title defining
+        it, or to None for the titles of several sections, which cannot be
+        referenced by name.  Components added to containers after these were
+        added to the document are not indexed until *check_references()*.'''
+        return self._targets
+
+    def check_references(self) :
+        '''return a list of (name, component) for the references in the
+        ReStText of the document to names that are not hyperlink targets, or
+        are ambiguous, e.g.::
+
+          >>> for name, text in doc.check_references() :
+          ...     print('broken reference %s_ in %r'%(name,text.source[:40]))
+
+        The targets are indexed again from the whole document, together with
+        the explicit and inline targets in the text, so it need not be
+        called last.  References are found with a regular expression rather
+        than by parsing the document, in a fraction of the time, so ones in
+        literal blocks are checked too and anonymous references are not.'''
+        targets = {}
+        for name, target, container in _iter_targets(self) :
+            _index_target(targets,name,target)
+
+        references = []
+        for component, depth in self.walk() :
+            if isinstance(component,ReStText) :
+                references.extend(_scan_references((component,),targets))
+            elif isinstance(component,_ReStSpilled) :
+                for name in component._text_targets :
+                    targets.setdefault(name,component)
+                references.extend((name,component) for name in component._references)
+        self._targets = {name:targets[name] for name in targets
+                         if not isinstance(targets[name],(ReStText,_ReStSpilled))}
+        return [(name,text) for name, text in references
+                if targets.get(_target_name(name)) is None]
+
+    def write(self,workers=None,threads=False) :
         '''write the contents of the document to file, can be called multiple
         times and will write multiple times, so you probably don't want to do
-        that'''
-        self._f.write(self.get_text())
+        that.  The document is streamed to the file component by component
+        with *render_to()* rather than built as a single string first.
+
+        With *workers* greater than 1 the top level components, e.g. the
+        sections, are rendered in parallel in a pool of that many processes,
+        or threads if *threads* is True, and written in their original order.
+        The output is identical to a serial write.  Components are sent to
+        worker processes with *serialize()*, those that cannot be serialized,
+        like tables streamed from a generator, are rendered in this process
+        when their turn comes.  At most 2 * *workers* components are rendered
+        ahead of the one being written.
+
+        Returns False if the document was opened with *skip_unchanged* and
+        the file was left untouched, True otherwise.'''
+        if not workers or workers < 2 or not self._dirty :
+            if self._f is not None and self._spill is None :
+                self.render_to(self._f)
+                return True
+        return self._write_components(self._iter_rendered(workers,threads))
+
+    def write_sharded(self,max_bytes=None,max_rows=None,section_level=None,shard_dir=None,
+                      workers=None,threads=False) :
+        '''write the document split into several files, the parts selected
+        by the sharding policy each going to a file of its own that is
+        included in its place with an include directive:
+
+        * sections at level *section_level*
+        * tables, ReStTable or ReStSimpleTable, of more than *max_rows* rows,
+          streamed rows being counted as they are read
+        * sections and tables of more than *max_bytes* characters, after
+          their own shards are replaced by includes
+
+        Shards may contain shards of their own.  They are written to
+        *shard_dir*, by default the directory of the document file, named
+        after the document file and the position of the top level component
+        they are part of, e.g. ``report_3_1.rst`` for the first shard of the
+        third component of ``report.rst``, so a shard keeps its name between
+        runs as long as the document structure does.  Shard files are only
+        replaced if their content changed, see *skip_unchanged*, so
+        downstream builds can cache them.  Shards left from earlier writes
+        that produced more of them are not removed.
+
+        The top level components are rendered in parallel as in *write()*
+        if *workers* is greater than 1, each writing its own shards.  The
+        main file is written as by *write()*.  Returns the list of shard
+        file paths in document order.
+
+        A document with a *memory_budget* cannot be sharded, since the
+        components it spilled are kept only as text, a ReStUtilException is
+        raised.'''
+        sharder = self._sharder(max_bytes,max_rows,section_level,shard_dir)
+
+        shards = []
+        def rendered() :
+            for component, (text, component_shards) in self._iter_rendered(workers,threads,sharder) :
+                shards.extend(component_shards)
+                yield component, (text,)
+        self._write_components(rendered())
+        return shards
+
+    def _sharder(self,max_bytes,max_rows,section_level,shard_dir) :
+        if self._memory_budget is not None and (max_bytes,max_rows,section_level) != (None,None,None) :
+            # spilled components are only text, the policy cannot see into them
+            raise ReStUtilException('A document with a memory_budget cannot be written sharded')
+        if shard_dir is None :
+            if self._fn is None :
+                raise ReStUtilException('ReStDocument needs a filename or shard_dir to write shards')
+            shard_dir = os.path.dirname(self._fn)
+        if self._fn is None :
+            include_dir, stem = shard_dir, 'shard'
+        else :
+            include_dir = os.path.relpath(shard_dir or '.',os.path.dirname(self._fn) or '.')
+            stem = os.path.splitext(os.path.basename(self._fn))[0]
+        include_dir = '' if include_dir == '.' else include_dir
+        return _Sharder(shard_dir,include_dir,stem,max_bytes,max_rows,section_level)
+
+    @property
+    def content_hash(self) :
+        'sha256 hex digest of the output of the last write with *skip_unchanged*'
+        return self._content_hash
+
+    @property
+    def section_hashes(self) :
+        '''list of (title, sha256 hex digest) of the output of each top level
+        component in the last write with *skip_unchanged*, the title is None
+        for components without one.  Comparing them between writes shows
+        which sections changed.'''
+        return self._section_hashes
+
+    def _iter_rendered(self,workers,threads,render=None) :
+        # yield (component, result) for the top level components in order,
+        # result being render(component,index), computed in a pool if there
+        # are several workers.  Without render the result is the chunks of
+        # the component, streamed here or rendered whole in the pool
+        def local(component,index) :
+            if render is None :
+                return component.iter_text()
+            return render(component,index)
+        if not workers or workers < 2 :
+            for index, component in enumerate(self.components) :
+                yield component, local(component,index)
+            return
+        if threads :
+            pool = concurrent.futures.ThreadPoolExecutor(workers)
+        else :
+            pool = concurrent.futures.ProcessPoolExecutor(workers)
+        with pool :
+            for index, component, future in self._submit_ordered(pool,2*workers,threads,render) :
+                if future is None :
+                    yield component, local(component,index)
+                elif render is None :
+                    yield component, (future.result(),)
+                else :
+                    yield component, future.result()
+
+    def _write_components(self,rendered) :
+        # write (component, chunks) pairs to the document file
+        if self._f is None :
+            return self._write_if_changed(rendered)
+        write = self._f.write
+        write('\n')
+        for component, chunks in rendered :
+            if isinstance(component,_ReStSpilled) :
+                component.copy_to(self._f)
+            else :
+                for chunk in chunks :
+                    write(chunk)
+            write('\n')
+        return True
+
+    def _write_if_changed(self,rendered,buffer_size=65536) :
+        f = _AtomicFile(self._fn)
+        section_hashes = []
+        try :
+            f.write('\n')
+            for component, chunks in rendered :
+                section_digest = hashlib.sha256()
+                if isinstance(component,_ReStSpilled) :
+                    chunks = ()
+                    for data in component.iter_bytes() :
+                        section_digest.update(f.write(data))
+                buf, size = [], 0
+                for chunk in itertools.chain(chunks,(None,)) :
+                    if chunk is not None :
+                        buf.append(chunk)
+                        size += len(chunk)
+                        if size < buffer_size :
+                            continue
+                    section_digest.update(f.write(''.join(buf)))
+                    buf, size = [], 0
+                section_hashes.append((getattr(component,'title',None),section_digest.hexdigest()))
+                f.write('\n')
+        except BaseException :
+            f.discard()
+            raise
+        self._content_hash = f.digest.hexdigest()
+        self._section_hashes = section_hashes
+        return f.close()
+
+    def _submit_ordered(self,pool,window,threads,render=None) :
+        # yield (index, component, future) in order, keeping up to window
+        # components submitted ahead, future is None for components to be
+        # rendered by the caller.  Without render only dirty components are
+        # submitted, the others have their text already
+        pending = collections.deque()
+        for index, component in enumerate(self.components) :
+            # reservations are rendered once done, so write what is ready
+            # while waiting for one
+            if isinstance(component,ReStReservation) and not component._filled :
+                while pending :
+                    yield pending.popleft()
+                component.wait()
+            future = None
+            if render is not None or (component._dirty and not isinstance(component,_ReStSpilled)) :
+                func = render or _render_component
+                if threads :
+                    future = pool.submit(func,component,index)
+                elif not _has_csv_file(component) :
+                    try :
+                        data = serialize(component,keep_text=True)
+                    except ReStUtilException :
+                        pass
+                    else :
+                        future = pool.submit(_render_serialized,data,func,index)
+            pending.append((index,component,future))
+            if len(pending) >= window :
+                yield pending.popleft()
+        while pending :
+            yield pending.popleft()
+
+    async def awrite(self,stream=None,executor=None) :
+        '''asynchronously write the document to *stream*, or to the document's
+        own file if not given, without blocking the event loop, e.g.::
+
+          >>> await doc.awrite(writer)
+
+        Control returns to the loop between components, and tables are
+        rendered in *executor* if one is given, see *arender_to()*.  A
+        document opened with *skip_unchanged* is written to its file with
+        *write()* in *executor* if no *stream* is given.'''
+        if stream is None and self._f is None :
+            await asyncio.get_running_loop().run_in_executor(executor,self.write)
+            return
+        await self.arender_to(self._f if stream is None else stream,executor)
 
     def close(self) :
         '''close the file pointer of the document, subsequent writes will fail'''
-        self._f.close()
+        if self._f is not None :
+            self._f.close()
+        if self._spill is not None :
+            self._spill.close()
 
 
 class ReStText(ReStBase) :
-    '''Basic text block, text wrapped to 80 characters by default'''
+    '''Basic text block, text wrapped to 80 characters by default.  The text
+    is kept as given in *source* and only wrapped when rendered.  *escape*
+    is the mode of *escape_text()* used on the wrapped text, so text from
+    untrusted sources is rendered as is, whatever lines wrapping makes.'''
+
+    __slots__ = ('source','width','escape')
 
-    def __init__(self,text,width=80) :
+    def __init__(self,text,width=80,escape=None) :
         ReStBase.__init__(self)
-        self.text = textwrap.fill(text,width,
-                                  break_long_words=True)
-        self.text += '\n'
+        self.source = text
+        self.width = width
+        self.escape = _check_escape(escape)
+
+    def escaped_source(self) :
+        'return *source* wrapped to *width* and escaped with the *escape* mode'
+        return escape_text(fill_text(self.source,self.width),self.escape)
+
+    def iter_parts(self) :
+        yield self.escaped_source()+'\n'
 
 
 class ReStImage(ReStBase) :
     '''Image directive, image URI is required, options (height, width, etc.) are
     specified as a dictionary to the constructor'''
 
-    def __init__(self,image_fn,options={}) :
+    __slots__ = ('image_fn','options')
+
+    def __init__(self,image_fn,options=None) :
         ReStBase.__init__(self)
         self.image_fn = image_fn
-        self.options = options
+        self.options = options if options is not None else {}
 
-    def build_text(self) :
-        self.text = '.. image:: %s\n'%self.image_fn
+    def iter_parts(self) :
+        yield '.. image:: %s\n'%self.image_fn
+        yield ReStIndent()
         for k,v in self.options.items() :
-            self.text += '   :%s: %s\n'%(str(k),str(v))
-        self.text += '\n'
+            yield ':%s: %s\n'%(str(k),str(v))
+        yield ReStIndent.END
+        yield '\n'
 
 
 class ReStFigure(ReStBase) :
@@ -179,42 +1918,133 @@ class ReStFigure(ReStBase) :
     options (height, width, etc.) are specified as a dictionary to
     the constructor'''
 
-    def __init__(self,image_fn,caption='',options={}) :
+    __slots__ = ('image_fn','caption','options')
+
+    def __init__(self,image_fn,caption='',options=None) :
         ReStBase.__init__(self)
         self.image_fn = image_fn
         self.caption = caption
-        self.options = options
+        self.options = options if options is not None else {}
 
-    def build_text(self) :
-        self.text = '.. figure:: %s\n'%self.image_fn
+    def iter_parts(self) :
+        yield '.. figure:: %s\n'%self.image_fn
+        yield ReStIndent()
         for k,v in self.options.items() :
-            self.text += '   :%s: %s\n'%(str(k),str(v))
-        self.text += textwrap.fill(self.caption,
-                                   80,
-                                   initial_indent='   ',
-                                   subsequent_indent='   ',
-                                   break_long_words=True,
-                                   ) + '\n'
+            yield ':%s: %s\n'%(str(k),str(v))
+        yield fill_text(self.caption,77)+'\n'
+
+def _as_columns(data) :
+    '''return (names, columns) for column oriented table data, i.e. a dict of
+    columns, a pandas DataFrame or a numpy structured array, each column as a
+    list of values, or None if *data* is a sequence of rows'''
+    if isinstance(data,dict) :
+        names, columns = list(data.keys()), list(data.values())
+    elif hasattr(data,'columns') and hasattr(data,'iloc') : # DataFrame
+        names = list(data.columns)
+        columns = [data[n] for n in names]
+    elif getattr(getattr(data,'dtype',None),'names',None) : # structured array
+        names = list(data.dtype.names)
+        columns = [data[n] for n in names]
+    else :
+        return None
+    columns = [c.tolist() if hasattr(c,'tolist') else list(c) for c in columns]
+    if len(set(len(c) for c in columns)) > 1 :
+        raise ReStUtilException('Not all table columns have the same length: %s'%
+                                dict(zip(names,[len(c) for c in columns])))
+    return [str(n) for n in names], columns
+
 
 class ReStSimpleTable(ReStBase) :
     '''Simple table markup block, accepts header list and data list of lists,
     all top level lists must have same length unless *ignore_missing* is True,
     in which case all data rows are either truncated or extended to match the
     header or the longest data row if there is no header.
+
+    *data* may instead be column oriented, a dict mapping column names to
+    columns, a pandas DataFrame or a numpy structured array.  The column names
+    are used as the header if *header* is None.  Column data is formatted and
+    measured a column at a time and the rows are assembled with a single join,
+    which is much faster than the row by row path for large tables.
+
+    A list of rows is copied into *data*, which may then be appended to or
+    otherwise changed in place, marking the table dirty.  Changes to the rows
+    themselves must be followed by *invalidate()*.
+
+    *data* may also be any iterable of rows without a length, e.g. a generator
+    or a database cursor, in which case the table is streamed and never holds
+    more than one row in memory.  If *col_widths* is given the rows are
+    formatted as they are read, otherwise a first pass computes the column
+    widths while spilling the split rows to a temporary file, which the second
+    pass reads back.  A streamed table with *col_widths* can only be rendered
+    once, since its rows are consumed.  Row lengths of streamed data are
+    checked as the rows are read.
+
+    *col_widths* fixes the width of each column rather than computing it from
+    the data, a cell line wider than its column raises a ReStUtilException.
+
+    *formats* maps columns to the function used to turn a cell value into
+    text in place of *str()*, either a callable or a format string such as
+    ``'{:.2f}'`` or ``'%.2f'``.  *align* maps columns to ``'left'``,
+    ``'right'`` or ``'center'`` (or ``'l'``, ``'r'``, ``'c'``), data cells are
+    left aligned by default.  Either may be a dict keyed by header name or
+    column index, or a list with an entry per column.  Both are compiled once
+    per column when the table is rendered, e.g.::
+
+      >>> ReStSimpleTable(['host','latency','count'],rows,
+      ...                 formats={'latency':'{:.2f}','count':'{:,d}'},
+      ...                 align={'latency':'right','count':'right'})
+
+    *escape* is the mode of *escape_text()* applied to the formatted text of
+    the data cells, and to the header names in ``'inline'`` mode for either
+    mode, since they are styled with inline markup.  Column oriented data
+    is escaped a column at a time, skipping columns without markup
+    characters with a single search.  Cells holding ReSt* components are
+    not escaped.
     '''
 
+    __slots__ = ('header','header_style','column_names','data','ignore_missing',
+                 'col_widths','formats','align','escape','_spill','_packed')
+
+    OFFLOAD = True
+
+    _LISTS = ('data',)
+
+    ALIGNMENTS = {'left':str.ljust,'l':str.ljust,
+                  'right':str.rjust,'r':str.rjust,
+                  'center':str.center,'c':str.center}
+
     def __init__(self,header,data,max_col_width=None,ignore_missing=False,
-                 header_style='*%s*') :
+                 header_style='*%s*',col_widths=None,formats=None,align=None,escape=None) :
+
+        # rows of iterables without a length are only available while rendering
+        streamed = not hasattr(data,'__len__')
+        columnar = _as_columns(data)
+
+        if columnar is not None :
+            if header is None :
+                header = columnar[0]
+            elif not ignore_missing and len(header) != len(columnar[1]) :
+                raise ReStUtilException('Number of data columns does not match header:\n%s\n%s'%(header,columnar[0]))
 
         # check to make sure the data rows have the same number of entries as the header
-        if not ignore_missing and header is not None and any([len(x)!= len(header) for x in data]) :
+        elif not streamed and not ignore_missing and header is not None and any([len(x)!= len(header) for x in data]) :
             raise ReStUtilException('Not all data rows have same length as header:\n%s\n%s'%(header,data))
 
         ReStBase.__init__(self)
         self.header = header
         self.header_style = header_style or '%s'
+        self.column_names = header and list(header)
+        if _check_escape(escape) not in (None,'none') and header :
+            self.header = [escape_text(str(h),'inline') for h in header]
         self.header = header and [self.header_style%h for h in self.header]
         self.data = data
+        self.ignore_missing = ignore_missing
+        self.col_widths = col_widths
+        self.formats = formats
+        self.align = align
+        self.escape = escape
+        self._spill = None
+        self._packed = None
 
         # max_col_width is now deprecated
         if max_col_width is not None :
@@ -222,83 +2052,499 @@ class ReStSimpleTable(ReStBase) :
                              'constructor is deprecated, user must text wrap ' \
                              'content manually with new lines\n')
 
-    def build_text(self) :
+    def __getattr__(self,name) :
+        # the data of a table read by deserialize() is unpacked on first use
+        packed = getattr(self,'_packed',None) if name == 'data' else None
+        if packed is None :
+            return ReStBase.__getattr__(self,name)
+        data = _unpack_table_data(*packed)
+        if type(data) is list :
+            data = _ReStList(self,data)
+        object.__setattr__(self,'data',data)
+        self._packed = None
+        return data
+
+    def iter_parts(self) :
+        columnar = _as_columns(self.data)
+        if columnar is not None :
+            return self._iter_columns(columnar[1])
+        elif hasattr(self.data,'__len__') :
+            return self._iter_list()
+        elif self.col_widths is not None :
+            return self._iter_stream()
+        return self._iter_spilled()
+
+    def _column_index(self,key) :
+        if isinstance(key,int) :
+            return key
+        try :
+            return self.column_names.index(key)
+        except (AttributeError,ValueError) :
+            raise ReStUtilException('Unknown table column %r, columns are %s'%(key,self.column_names))
+
+    def _per_column(self,spec,compile_spec) :
+        # {column index: compiled spec} from a dict or list spec
+        if spec is None :
+            return {}
+        elif isinstance(spec,dict) :
+            items = spec.items()
+        else :
+            items = enumerate(spec)
+        return dict((self._column_index(k),compile_spec(v)) for k,v in items if v is not None)
+
+    def _compile_format(self,fmt) :
+        if callable(fmt) :
+            return fmt
+        elif '{' in fmt :
+            return fmt.format
+        return fmt.__mod__
+
+    def _compile_align(self,align) :
+        try :
+            return ReStSimpleTable.ALIGNMENTS[align]
+        except KeyError :
+            raise ReStUtilException('Unknown column alignment %r, use one of %s'%
+                                    (align,sorted(ReStSimpleTable.ALIGNMENTS)))
+
+    def _formatters(self,num_cols,escape=True) :
+        '''return the cell formatting function for each of *num_cols* columns,
+        which escapes the text unless *escape* is False'''
+        fmts = self._per_column(self.formats,self._compile_format)
+        formatters = [fmts.get(i,str) for i in range(num_cols)]
+        if escape and self.escape not in (None,'none') :
+            mode = self.escape
+            formatters = [lambda value, fmt=fmt: escape_text(fmt(value),mode) for fmt in formatters]
+        return formatters
+
+    def _justifiers(self,num_cols) :
+        '''return the justification function for each of *num_cols* columns'''
+        justs = self._per_column(self.align,self._compile_align)
+        return [justs.get(i,str.ljust) for i in range(num_cols)]
+
+    def _split_cell(self,data_cell,fmt=str) :
+        if hasattr(data_cell,'get_text') :
+            cell = data_cell.get_text().split('\n')
+        else :
+            cell = fmt(data_cell).split('\n')
+        if len(cell[-1]) == 0 : # splitting can sometimes introduce blank last entry
+            cell = cell[:-1]
+        return cell
+
+    def _split_row(self,row,longest_row,formatters) :
+        # missing cells are padded with the empty split of ''
+        cells = [self._split_cell(c,f) for c,f in zip(row[:longest_row],formatters)]
+        cells.extend([] for i in range(longest_row-len(cells)))
+        return cells
+
+    def _check_row(self,row) :
+        if not self.ignore_missing and self.header is not None and len(row) != len(self.header) :
+            raise ReStUtilException('Data row does not have same length as header:\n%s\n%s'%(self.header,row))
+
+    def _check_widths(self,wrapped_row_data,col_widths) :
+        for cell,w in zip(wrapped_row_data,col_widths) :
+            for line in cell :
+                if _display_width(line) > w :
+                    raise ReStUtilException('Cell text wider than its column width %d:\n%s'%(w,line))
+
+    def _fixed_widths(self,col_widths) :
+        # factor header into column widths
+        if self.header is not None :
+            col_widths = [max(_display_width(x),y) for x,y in zip(self.header,col_widths)]
+        return col_widths
+
+    def _iter_list(self,data=None,formatters=None) :
+        data = self.data if data is None else data
 
         # prepare data rows to calculate column widths, text wrapping does not
         # always respect column width on long words
         wrapped_data = []
-        if self.header is not None :
+        if self.col_widths is not None :
+            col_widths = list(self.col_widths)
+            longest_row = len(col_widths)
+        elif self.header is not None :
             col_widths = [0]*len(self.header)
             longest_row = len(self.header)
         else :
             col_widths = [0]*255 # should never have more than 255 column, right?
-            longest_row = max(len(r) for r in self.data)
+            longest_row = max(len(r) for r in data)
 
-        for row in self.data :
+        formatters = formatters or self._formatters(longest_row)
+        for row in data :
 
-            extra = ['']*(max(0,longest_row-len(row)))
-            row = tuple(row[:longest_row])+tuple(extra)
+            wrapped_row_data = self._split_row(row,longest_row,formatters)
+            wrapped_data.append(wrapped_row_data)
 
-            wrapped_row_data = []
-            for data_cell in row :
-                if hasattr(data_cell,'get_text') :
-                    cell = data_cell.get_text().split('\n')
-                else :
-                    cell = str(data_cell).split('\n')
-                if len(cell[-1]) == 0 : # splitting can sometimes introduce blank last entry
-                    cell = cell[:-1]
-                wrapped_row_data.append(cell)
+            # find actual column widths based on text wrapped data
+            if self.col_widths is None :
+                wrapped_col_widths = _lines_widths(wrapped_row_data)
+                col_widths = [max(x,w) for x,w in zip(wrapped_col_widths,col_widths)]
+            else :
+                self._check_widths(wrapped_row_data,col_widths)
+
+        return self._iter_grid(self._fixed_widths(col_widths),wrapped_data)
+
+    def _iter_stream(self) :
+        # rows formatted as they are read using the declared column widths
+        if self.data is None :
+            raise ReStUtilException('Streamed table rows have already been consumed, '
+                                    'tables with col_widths can only be rendered once')
+        rows, self.data = self.data, None
+        col_widths = list(self.col_widths)
+        formatters = self._formatters(len(col_widths))
+
+        def wrapped_rows() :
+            for row in rows :
+                self._check_row(row)
+                wrapped_row_data = self._split_row(row,len(col_widths),formatters)
+                self._check_widths(wrapped_row_data,col_widths)
+                yield wrapped_row_data
+
+        return self._iter_grid(self._fixed_widths(col_widths),wrapped_rows())
+
+    def _iter_spilled(self) :
+        # first pass computes column widths and writes the split rows to a
+        # temporary file, which is kept for later renders
+        if self._spill is None :
+            spill = tempfile.TemporaryFile()
+            if self.header is not None :
+                col_widths = [0]*len(self.header)
+                longest_row = len(self.header)
+            else :
+                col_widths = []
+                longest_row = None
+            formatters = self._formatters(longest_row or 0)
+            for row in self.data :
+                self._check_row(row)
+                if len(formatters) < len(row) and longest_row is None :
+                    formatters = self._formatters(len(row))
+                wrapped_row_data = self._split_row(row,longest_row or len(row),formatters)
+                pickle.dump(wrapped_row_data,spill,pickle.HIGHEST_PROTOCOL)
+                wrapped_col_widths = _lines_widths(wrapped_row_data)
+                if len(wrapped_col_widths) > len(col_widths) :
+                    col_widths.extend([0]*(len(wrapped_col_widths)-len(col_widths)))
+                col_widths[:len(wrapped_col_widths)] = [max(x,w) for x,w in zip(wrapped_col_widths,col_widths)]
+            self.data = None
+            self._spill = (spill,col_widths)
+
+        spill, col_widths = self._spill
+
+        def wrapped_rows() :
+            spill.seek(0)
+            while True :
+                try :
+                    wrapped_row_data = pickle.load(spill)
+                except EOFError :
+                    break
+                # rows shorter than the longest row are padded with empty cells
+                wrapped_row_data.extend([] for i in range(len(col_widths)-len(wrapped_row_data)))
+                yield wrapped_row_data
+
+        return self._iter_grid(self._fixed_widths(col_widths),wrapped_rows())
+
+    def _str_columns(self,columns) :
+        '''return (number of columns, columns of formatted cell text)'''
+        # match the number of columns to the header as rows are in _split_row
+        num_rows = len(columns[0]) if columns else 0
+        if self.col_widths is not None :
+            num_cols = len(self.col_widths)
+        elif self.header is not None :
+            num_cols = len(self.header)
+        else :
+            num_cols = len(columns)
+        columns = columns[:num_cols]+[['']*num_rows]*(num_cols-len(columns))
+        return num_cols, [_escape_column(list(map(f,col)),self.escape)
+                          for col,f in zip(columns,self._formatters(num_cols,escape=False))]
+
+    def _cell_rows(self) :
+        '''return (number of columns, list of rows of cell text), see
+        *_iter_cell_rows()*.  Streamed rows are read into memory and kept for
+        later renders.'''
+        if self._spill is None and self.data is not None and not hasattr(self.data,'__len__') :
+            self.data = list(self.data)
+        num_cols, rows = self._iter_cell_rows()
+        return num_cols, list(rows)
+
+    def _iter_cell_rows(self) :
+        '''return (number of columns, iterator over rows of cell text) with
+        the cells formatted, split and padded as for rendering, the lines of
+        each cell joined with newlines.  For output that does not lay the
+        table out in a grid, so needs no pass over the data for the column
+        widths.  Streamed rows are read as the iterator is consumed, and can
+        only be read once.'''
+        columnar = _as_columns(self.data)
+        if columnar is not None :
+            num_cols, str_columns = self._str_columns(columnar[1])
+            return num_cols, zip(*str_columns)
+
+        if self._spill is not None :
+            spill, col_widths = self._spill
+            num_cols = len(col_widths)
+            def spilled_rows() :
+                spill.seek(0)
+                while True :
+                    try :
+                        row = pickle.load(spill)
+                    except EOFError :
+                        break
+                    row.extend([] for i in range(num_cols-len(row)))
+                    yield ['\n'.join(cell) for cell in row]
+            return num_cols, spilled_rows()
+
+        if self.data is None :
+            raise ReStUtilException('Streamed table rows have already been consumed')
+        rows = self.data
+        if not hasattr(rows,'__len__') :
+            rows, self.data = iter(rows), None
+        if self.col_widths is not None :
+            num_cols = len(self.col_widths)
+        elif self.header is not None :
+            num_cols = len(self.header)
+        elif self.data is not None :
+            num_cols = max([len(r) for r in rows] or [0])
+        else :
+            # streamed rows without a header are as long as the first one
+            first = next(rows,None)
+            num_cols = 0 if first is None else len(first)
+            rows = itertools.chain(() if first is None else (first,),rows)
+        formatters = self._formatters(num_cols)
+
+        def cell_rows() :
+            for row in rows :
+                self._check_row(row)
+                yield ['\n'.join(cell) for cell in self._split_row(row,num_cols,formatters)]
+        return num_cols, cell_rows()
+
+    def _iter_columns(self,columns) :
+
+        num_rows = len(columns[0]) if columns else 0
+        num_cols, str_columns = self._str_columns(columns)
+        ascii_columns = [all(map(str.isascii,col)) for col in str_columns]
+
+        # multiline cells need the row by row layout
+        if any('\n' in ''.join(col) for col in str_columns) :
+            return self._iter_list(list(zip(*str_columns)),[str]*num_cols)
+
+        if self.col_widths is not None :
+            col_widths = list(self.col_widths)
+            for col,w in zip(str_columns,col_widths) :
+                self._check_widths([col],[w])
+        else :
+            col_widths = [max(map(len if a else _display_width,col),default=0)
+                          for col,a in zip(str_columns,ascii_columns)]
+        col_widths = self._fixed_widths(col_widths)
 
-            # pad the wrapped row data with empty strings for shorter cells
-            max_data_rows = max([len(x) for x in wrapped_row_data])
-            for x in wrapped_row_data :
-                x.extend(['']*(max(1,max_data_rows-len(x))))
+        return self._iter_column_grid(col_widths,str_columns,num_rows,ascii_columns)
 
-            wrapped_data.append(wrapped_row_data)
+    def _iter_column_grid(self,col_widths,str_columns,num_rows,ascii_columns,block_size=10000) :
 
-            # find actual column widths based on text wrapped data
-            wrapped_col_widths = [max(len(y) for y in x) for x in wrapped_row_data]
-            col_widths = [max(x,w) for x,w in zip(wrapped_col_widths,col_widths)]
+        line_sep = '+-'+'-+-'.join(['-'*x for x in col_widths])+'-+'+'\n'
+        yield line_sep
 
-        # factor header into column widths
         if self.header is not None :
-            col_widths = [max(len(x),y) for x,y in zip(self.header,col_widths)]
+            yield '| '+' | '.join([_justify(str.center,h,w) for h,w in zip(self.header,col_widths)])+' |'+'\n'
+            yield line_sep
+
+        # rows where every cell has text get a blank line below it, as the
+        # padding in _iter_grid does for single line cells
+        blank_line = '| '+' | '.join([' '*w for w in col_widths])+' |'+'\n'
+        full_end = ' |\n'+blank_line+line_sep
+        part_end = ' |\n'+line_sep
+
+        padded_columns = [list(map(j,col,itertools.repeat(w,num_rows))) if a else
+                          list(map(functools.partial(_justify,j),col,itertools.repeat(w,num_rows)))
+                          for col,w,j,a in zip(str_columns,col_widths,self._justifiers(len(col_widths)),
+                                               ascii_columns)]
+        full_rows = [all(r) for r in zip(*str_columns)]
+
+        for start in range(0,num_rows,block_size) :
+            stop = start+block_size
+            lines = map(' | '.join,zip(*[col[start:stop] for col in padded_columns]))
+            full = full_rows[start:stop]
+            if all(full) :
+                yield '| '+(full_end+'| ').join(lines)+full_end
+            else :
+                yield ''.join(['| '+l+(full_end if f else part_end) for l,f in zip(lines,full)])
+
+    def _iter_grid(self,col_widths,wrapped_data) :
 
         # line separator
         line_sep = '+-'+'-+-'.join(['-'*x for x in col_widths])+'-+'+'\n'
-        self.text = line_sep
+        yield line_sep
 
         # header row
         if self.header is not None :
-            self.text += '| '+' | '.join([h.center(w) for h,w in zip(self.header,col_widths)])+' |'+'\n'
-            self.text += line_sep
+            yield '| '+' | '.join([_justify(str.center,h,w) for h,w in zip(self.header,col_widths)])+' |'+'\n'
+            yield line_sep
 
         # data rows
+        justifiers = self._justifiers(len(col_widths))
         for row in wrapped_data :
+
+            # pad the wrapped row data with empty strings for shorter cells
+            max_data_rows = max([len(x) for x in row])
+            for x in row :
+                x.extend(['']*(max(1,max_data_rows-len(x))))
+
             for row_line in zip(*row) :
-                self.text += '| '+' | '.join([x.ljust(w) for x,w in zip(row_line,col_widths)])+' |'+'\n'
-            self.text += line_sep
+                line = '| '+' | '.join([j(x,w) for x,w,j in zip(row_line,col_widths,justifiers)])+' |'+'\n'
+                # padded by length, which is the display width of ASCII
+                if not line.isascii() :
+                    line = '| '+' | '.join([_justify(j,x,w) for x,w,j in zip(row_line,col_widths,justifiers)])+' |'+'\n'
+                yield line
+            yield line_sep
 
 
 class ReStTable(ReStBase) :
     '''Table directive, accepts header list and data list of lists, all top
     level lists must have same length unless *ignore_missing* is True, in which
     case all data rows are either truncated or extended to match the header.
+    *data*, *col_widths*, *formats*, *align* and *escape* are handled as in
+    ReStSimpleTable.
+
+    *mode* selects the table markup.  ``'grid'``, the default, is a table
+    directive around a ReStSimpleTable grid.  ``'list'`` is a list-table and
+    ``'csv'`` a csv-table, which need no pass over the data for the column
+    widths and no padding, so rows are formatted and written as they are
+    read, in blocks of *block_size* rows.  Streamed rows can then be
+    rendered without a temporary file, but only once.  They are also much
+    faster for docutils to parse than a grid, so are the better choice for
+    very large tables.  *col_widths* and *align* only apply to grids.
+
+    In csv mode, with *csv_file* the data is written to that file with the
+    csv module when the table is rendered, and the csv-table refers to it
+    with its *:file:* option rather than holding the data inline.  Docutils
+    resolves the path relative to the document, so a relative *csv_file* is
+    written relative to the directory of the ReStDocument holding the table,
+    which must then not be written to a shard in another directory.  The
+    file is only replaced if its content differs, so an unchanged file
+    keeps its modification time.
     '''
 
-    def __init__(self,header,data,title='',max_col_width=None,options={},ignore_missing=False) :
+    __slots__ = ('_simp_table','title','mode','csv_file','block_size')
+
+    OFFLOAD = True
+
+    MODES = ('grid','list','csv')
+
+    def __init__(self,header,data,title='',max_col_width=None,options=None,ignore_missing=False,
+                 col_widths=None,formats=None,align=None,mode='grid',csv_file=None,block_size=10000,
+                 escape=None) :
+        if mode not in ReStTable.MODES :
+            raise ReStUtilException('Unknown table mode %r, use one of %s'%(mode,', '.join(ReStTable.MODES)))
+        if csv_file is not None and mode != 'csv' :
+            raise ReStUtilException('csv_file is only used by csv mode tables')
         ReStBase.__init__(self)
         self._simp_table = ReStSimpleTable(header,data,
                                            max_col_width=max_col_width,
-                                           ignore_missing=ignore_missing)
+                                           ignore_missing=ignore_missing,
+                                           col_widths=col_widths,
+                                           formats=formats,
+                                           align=align,
+                                           escape=escape)
+        self._adopt(self._simp_table)
         self.title = title
-
-    def build_text(self) :
-        self.text = '.. table:: %s\n\n'%self.title
-        tab_text = self._simp_table.get_text()
-
-        # indent the table
-        self.text += '   '+tab_text.replace('\n','\n   ')
+        self.mode = mode
+        self.csv_file = csv_file
+        self.block_size = block_size
+
+    def _children(self) :
+        return (self._simp_table,)
+
+    def iter_parts(self) :
+        if self.mode == 'list' :
+            return self._iter_list_table()
+        elif self.mode == 'csv' :
+            return self._iter_csv_table()
+        return self._iter_grid_table()
+
+    def _iter_grid_table(self) :
+        yield '.. table:: %s\n\n'%self.title
+        yield ReStIndent()
+        yield self._simp_table
+
+    def _header_and_blocks(self) :
+        # the header cells, or None, and the rows of cell text in blocks
+        num_cols, rows = self._simp_table._iter_cell_rows()
+        header = self._simp_table.header
+        if header is not None :
+            header = (header[:num_cols]+['']*(num_cols-len(header)))
+        blocks = iter(functools.partial(_next_batch,rows,self.block_size),[])
+        return header, blocks
+
+    def _list_row(self,cells) :
+        lines = []
+        bullet = '* - '
+        for cell in cells :
+            lines.append((bullet+cell.replace('\n','\n    ')).rstrip(' ')+'\n')
+            bullet = '  - '
+        return ''.join(lines)
+
+    def _iter_list_table(self) :
+        header, blocks = self._header_and_blocks()
+        yield '.. list-table:: %s\n'%self.title
+        yield ReStIndent()
+        if header is not None :
+            yield ':header-rows: 1\n\n'
+            yield self._list_row(header)
+        else :
+            yield '\n'
+        for block in blocks :
+            yield ''.join(map(self._list_row,block))
+        yield '\n'
+
+    def _csv_path(self) :
+        # the path csv_file is written to, relative to the directory of the
+        # document the table is in, as docutils reads it
+        stack = list(self.parents())
+        while stack :
+            container = stack.pop()
+            if isinstance(container,ReStDocument) and container._fn is not None :
+                return os.path.join(os.path.dirname(container._fn),self.csv_file)
+            stack.extend(container.parents())
+        return self.csv_file
+
+    def _iter_csv_table(self) :
+        header, blocks = self._header_and_blocks()
+        yield '.. csv-table:: %s\n'%self.title
+        yield ReStIndent()
+        if header is not None :
+            yield ':header-rows: 1\n'
+
+        if self.csv_file is not None :
+            # only replaced if the content differs, see ReStDocument
+            f = _AtomicFile(self._csv_path())
+            try :
+                buf = io.StringIO()
+                writer = csv.writer(buf,lineterminator='\n')
+                if header is not None :
+                    writer.writerow(header)
+                for block in itertools.chain(blocks,[[]]) :
+                    writer.writerows(block)
+                    f.write(buf.getvalue())
+                    buf.seek(0)
+                    buf.truncate()
+            except BaseException :
+                f.discard()
+                raise
+            f.close()
+            yield ':file: %s\n'%self.csv_file
+            yield ':encoding: utf-8\n\n'
+            return
+
+        # inline data as the directive content
+        yield '\n'
+        buf = io.StringIO()
+        writer = csv.writer(buf,lineterminator='\n')
+        if header is not None :
+            writer.writerow(header)
+        for block in itertools.chain(blocks,[[]]) :
+            writer.writerows(block)
+            text = buf.getvalue()
+            if text :
+                yield text
+                buf.seek(0)
+                buf.truncate()
+        yield '\n'
 
 
 class ReStHyperlink(ReStBase) :
@@ -307,26 +2553,31 @@ class ReStHyperlink(ReStBase) :
     in any other directive as *name_*.  Section titles, footnotes, and citations
     automatically generate hyperlink targets, per reSt documentation.'''
 
+    __slots__ = ('name','url','indirect')
+
     def __init__(self,name,url='',indirect=False) :
         ReStBase.__init__(self)
         self.name = name
         self.url = url
         self.indirect = indirect
 
-    def build_text(self) :
-        self.text = '.. _%s: %s\n'%(self.name,self.url)
+    def iter_parts(self) :
+        yield '.. _%s: %s\n'%(self.name,self.url)
         if self.indirect :
-            self.text += '\n__ %s_\n'%self.name
+            yield '\n__ %s_\n'%self.name
 
 class ReStInclude(ReStBase) :
     '''Include directive.  Allows the contents of one file to be embedded into
     another.'''
 
+    __slots__ = ('fn',)
+
     def __init__(self,fn) :
+        ReStBase.__init__(self)
         self.fn = fn
 
-    def build_text(self) :
-        self.text = '.. include:: %s\n\n'%self.fn
+    def iter_parts(self) :
+        yield '.. include:: %s\n\n'%self.fn
 
 class ReStHTMLStyle(ReStBase) :
     '''A set of raw directives that define some convenient formatting classes
@@ -378,23 +2629,571 @@ class ReStHTMLStyle(ReStBase) :
                      ('boldred','color:red;font-weight:bold;'),
                     ]
 
+    __slots__ = ('roles',)
+
     def __init__(self) :
         ReStBase.__init__(self)
         self.text = ''
-        self.roles = ReStHTMLStyle.DEFAULT_ROLES
+        # copied, appending to the roles of one style must not change the
+        # defaults of all the others
+        self.roles = list(ReStHTMLStyle.DEFAULT_ROLES)
 
-    def build_text(self) :
+    def iter_parts(self) :
 
         rst_role_tmpl = '.. role:: %s\n\n'
-        rst_role_txt = ''.join(rst_role_tmpl%r for r,c in self.roles)
+        for r,c in self.roles :
+            yield rst_role_tmpl%r
 
         html_style_tmpl = '      .%s { %s }\n'
-        html_style_txt = '.. raw:: html\n\n'
-        html_style_txt += '   <style>\n'
-        html_style_txt += ''.join(html_style_tmpl%r for r in self.roles)
-        html_style_txt += '   </style>\n\n'
+        yield '.. raw:: html\n\n'
+        yield '   <style>\n'
+        for r in self.roles :
+            yield html_style_tmpl%r
+        yield '   </style>\n\n'
+
+class ReStSlot(ReStBase) :
+    '''Named placeholder in a component tree compiled into a ReStTemplate,
+    filled with a new value each time the template is rendered.  The value is
+    passed through *factory*, if given, which returns the component to render
+    in place of the slot, e.g. a table around rows of data::
+
+      >>> ReStSlot('sales',lambda rows: ReStTable(['region','total'],rows))
+
+    A string is rendered as a ReStText, as in ReStContainer.add, and a
+    ReStSection is nested under the section holding the slot.  Slots can only
+    be rendered by a template.'''
+
+    __slots__ = ('name','factory')
+
+    def __init__(self,name,factory=None) :
+        ReStBase.__init__(self)
+        self.name = name
+        self.factory = factory
+
+    def make(self,value) :
+        '''return the component rendered in place of the slot for *value*'''
+        if self.factory is not None :
+            value = self.factory(value)
+        if isinstance(value,str) :
+            value = ReStText(value)
+        return value
+
+    def iter_parts(self) :
+        raise ReStUtilException('Template slot %r can only be rendered by a ReStTemplate'%self.name)
+
+
+class ReStTemplate(object) :
+    '''A component tree compiled for rendering many times with different
+    contents in its ReStSlot components, e.g.::
+
+      >>> sec = ReStSection('Sales report')
+      >>> sec.add(ReStSlot('customer'))
+      >>> sec.add(ReStSlot('sales',lambda rows: ReStTable(['region','total'],rows)))
+      >>> report = ReStTemplate(sec)
+      >>> report.render_to(f,customer='Customer: ACME',sales=rows)
+
+    The parts of the tree without slots, e.g. the section headers, styles and
+    static texts, are rendered once when the template is compiled and stored
+    as strings between the slots, so rendering only builds the components of
+    the slot values.  The output is the same as the tree with each slot
+    replaced by its component.  Changes to the tree after compiling are not
+    seen until *compile()* is called again.'''
+
+    def __init__(self,root) :
+        self.root = root
+        self.compile()
+
+    def compile(self) :
+        '''pre-render the static parts of the tree into *segments*, a list of
+        strings and (slot, section level) pairs'''
+        # the slots and their ancestors are walked, the rest is static
+        dynamic, path = set(), []
+        for component, depth in self.root.walk() :
+            del path[depth:]
+            path.append(component)
+            if isinstance(component,ReStSlot) :
+                dynamic.update(id(c) for c in path)
+
+        segments, static = [], []
+        stack = [(iter((self.root,)),0)]
+        while stack :
+            parts, level = stack[-1]
+            for part in parts :
+                if isinstance(part,str) :
+                    static.append(part)
+                elif isinstance(part,ReStSlot) :
+                    segments.append(''.join(static))
+                    segments.append((part,level))
+                    static = []
+                elif isinstance(part,ReStIndent) :
+                    raise ReStUtilException('Template slots cannot be placed in indented parts')
+                elif id(part) not in dynamic :
+                    static.extend(part.iter_text())
+                elif type(part).iter_parts is ReStBase.iter_parts :
+                    raise ReStUtilException('Template slots cannot be placed in a %s'%type(part).__name__)
+                else :
+                    if isinstance(part,ReStSection) :
+                        level = part.level
+                    stack.append((iter(part.iter_parts()),level))
+                    break
+            else :
+                stack.pop()
+        segments.append(''.join(static))
+        self.segments = [s for s in segments if s]
+        self.slot_names = set(s[0].name for s in self.segments if not isinstance(s,str))
+
+    def _check(self,values) :
+        missing = self.slot_names.difference(values)
+        unknown = set(values).difference(self.slot_names)
+        if missing or unknown :
+            raise ReStUtilException('Template slot values do not match the slots, missing %s, unknown %s'%
+                                    (sorted(missing),sorted(unknown)))
+
+    def iter_text(self,**values) :
+        '''generator yielding the text of the template with each slot
+        replaced by the component for its value in *values*'''
+        self._check(values)
+        for segment in self.segments :
+            if isinstance(segment,str) :
+                yield segment
+                continue
+            slot, level = segment
+            component = slot.make(values[slot.name])
+            if isinstance(component,ReStSection) and level :
+                component.level = level+1
+            for chunk in component.iter_text() :
+                yield chunk
+
+    def render(self,**values) :
+        '''return the text of the template filled with *values*'''
+        return ''.join(self.iter_text(**values))
+
+    def render_to(self,f,**values) :
+        '''write the text of the template filled with *values* to the
+        file-like object *f* chunk by chunk'''
+        write = f.write
+        for chunk in self.iter_text(**values) :
+            write(chunk)
+
+
+class ReStVisitor(object) :
+    '''Base class for passes over a component tree, e.g. collecting the
+    section titles of a document::
+
+      >>> class SectionTitles(ReStVisitor) :
+      ...     def __init__(self) :
+      ...         self.titles = []
+      ...     def visit_ReStSection(self,section) :
+      ...         self.titles.append((self.depth,section.title))
+      >>> SectionTitles().visit(doc).titles
+
+    *visit()* walks the tree in document order, calling
+    ``visit_<class name>(component)`` on entering each component and
+    ``depart_<class name>(component)`` after its descendants, if the visitor
+    has them.  Methods are looked up along the class hierarchy of the
+    component, so e.g. *visit_ReStContainer* also handles sections and
+    documents and *visit_ReStBase* handles every component.  *depth* is the
+    depth of the current component, 0 for the root.  A visit method returning
+    ReStVisitor.SKIP skips the descendants of its component.  The walk uses an
+    explicit stack, so trees of any depth can be visited.
+    '''
+
+    SKIP = 'skip'
+
+    depth = 0
+
+    def _methods(self,cls,cache) :
+        methods = cache.get(cls)
+        if methods is None :
+            visit = depart = None
+            for klass in cls.__mro__ :
+                visit = visit or getattr(self,'visit_'+klass.__name__,None)
+                depart = depart or getattr(self,'depart_'+klass.__name__,None)
+            methods = cache[cls] = (visit,depart)
+        return methods
+
+    def visit(self,component) :
+        '''visit *component* and all of its descendants, returns the visitor'''
+        cache = {}
+        stack = [(None,None,iter((component,)))]
+        while stack :
+            for comp in stack[-1][2] :
+                visit, depart = self._methods(type(comp),cache)
+                self.depth = len(stack)-1
+                if visit is not None and visit(comp) == ReStVisitor.SKIP :
+                    children = ()
+                else :
+                    children = comp._children()
+                stack.append((comp,depart,iter(children)))
+                break
+            else :
+                comp, depart, children = stack.pop()
+                if depart is not None :
+                    self.depth = len(stack)-1
+                    depart(comp)
+        return self
+
+
+def _import_docutils() :
+    # the doctree backend is optional, docutils is only imported when used
+    try :
+        import docutils.core
+        import docutils.nodes
+        import docutils.parsers.rst
+        import docutils.parsers.rst.languages
+        import docutils.parsers.rst.states
+        import docutils.readers.standalone
+    except ImportError :
+        raise ReStUtilException('The docutils doctree backend needs docutils, '
+                                'install it with: pip install docutils')
+    return docutils
+
+# cell and paragraph text the rst parser would make a single paragraph of:
+# no blank, indented or literal block lines and no line starting like a list
+# item, field, directive, table, quote or section adornment.  Numbers are
+# paragraphs unless they look like enumerators
+_DOCTREE_PARAGRAPH = re.compile(r'(?!.*::)(?:(?:(?![-*+#|:>.=~^`\'"<_(\[\d])(?![A-Za-z]{1,3}[.)] )'
+                                r'(?![IVXLCDMivxlcdm]+[.)] )\S[^\n]*'
+                                r'|-?\d[\d,_]*(?:\.\d+)?(?:[eE][-+]?\d+)?%?)(?:\n|\Z))+\Z',re.S)
+# text without inline markup, which is a plain text node
+_DOCTREE_PLAIN = re.compile(r'[^*`_|\\:@]*\Z')
+
+class ReStDoctreeBuilder(ReStVisitor) :
+    '''Optional backend converting a component tree straight into a docutils
+    document tree, skipping the rst text that docutils would otherwise have to
+    parse again, e.g.::
+
+      >>> html = ReStDoctreeBuilder().publish(doc,'html')
+
+    Sections, tables, figures, images and hyperlink targets become their
+    docutils nodes directly, with table cells as paragraphs, so large tables
+    are not laid out as grids and parsed back.  Only cell, paragraph and
+    caption text containing inline markup goes through the docutils inline
+    parser, and text with block markup, components without a node of their
+    own and indirect hyperlinks are parsed from their rst text.  The tree is
+    built inside a docutils reader, so the usual reader transforms, e.g.
+    reference resolution, are applied as for parsed text.  The rst text
+    output of the components is unaffected.
+
+    docutils is imported when a builder is created, a ReStUtilException is
+    raised if it is not installed.  *settings_overrides* are passed on to
+    docutils.'''
+
+    def __init__(self,settings_overrides=None) :
+        self.docutils = _import_docutils()
+        self.settings_overrides = settings_overrides
+
+    def _reader(self,component) :
+        builder, standalone = self, self.docutils.readers.standalone
+
+        class DoctreeReader(standalone.Reader) :
+            def parse(self) :
+                self.document = self.new_document()
+                builder._build(self.document,component)
+        return DoctreeReader()
+
+    def build(self,component) :
+        '''return the docutils document tree for *component*'''
+        return self.docutils.core.publish_doctree('',reader=self._reader(component),
+                                                  settings_overrides=self.settings_overrides)
+
+    def publish(self,component,writer_name='html') :
+        '''return the output of the docutils writer *writer_name* for
+        *component*, as docutils.core.publish_string would for its text'''
+        return self.docutils.core.publish_string('',reader=self._reader(component),
+                                                 writer_name=writer_name,
+                                                 settings_overrides=self.settings_overrides)
+
+    def _build(self,document,component) :
+        docutils = self.docutils
+        states = docutils.parsers.rst.states
+        self.nodes = docutils.nodes
+        self.document = document
+        self.parser = docutils.parsers.rst.Parser()
+        self.inliner = states.Inliner()
+        self.inliner.init_customizations(document.settings)
+        language = docutils.parsers.rst.languages.get_language(document.settings.language_code,
+                                                               document.reporter)
+        self.memo = states.Struct(document=document,reporter=document.reporter,
+                                  language=language,title_styles=[],section_level=0,
+                                  section_bubble_up_kludge=False,inliner=self.inliner)
+        self.parents = [document]
+        self.visit(component)
+
+    def _inline(self,text) :
+        # text nodes of a paragraph, title or caption
+        if _DOCTREE_PLAIN.match(text) :
+            return [self.nodes.Text(text)]
+        nodes, messages = self.inliner.parse(text,0,self.memo,self.parents[-1])
+        return nodes+messages
+
+    def _blocks(self,text) :
+        # body elements of a table cell or text block
+        if _DOCTREE_PARAGRAPH.match(text) :
+            return [self.nodes.paragraph(text,'',*self._inline(text))]
+        return self._parse(text)
+
+    def _parse(self,text) :
+        # parse rst text in the document, so its targets and references are
+        # registered with it, and take the new nodes out again
+        document = self.document
+        start = len(document.children)
+        self.parser.parse(text,document)
+        nodes = document.children[start:]
+        del document.children[start:]
+        return nodes
+
+    def _append(self,nodes) :
+        self.parents[-1].extend(nodes)
+
+    def visit_ReStBase(self,component) :
+        self._append(self._parse(component.get_text()))
+        return ReStVisitor.SKIP
+
+    def visit_ReStContainer(self,container) :
+        pass
+
+    def visit_ReStSection(self,section) :
+        nodes = self.nodes
+        node = nodes.section()
+        node += nodes.title(section.title,'',*self._inline(section.title))
+        node['names'].append(nodes.fully_normalize_name(section.title))
+        self.document.note_implicit_target(node,node)
+        self._append([node])
+        self.parents.append(node)
+
+    def depart_ReStSection(self,section) :
+        self.parents.pop()
+
+    def visit__ReStTitle(self,title) :
+        # the rst text of a document title is a section holding the rest of
+        # the document, which docutils promotes to the document title, the
+        # same for the subtitle within it
+        self.visit_ReStSection(title)
+
+    def visit_ReStText(self,text) :
+        source = text.escaped_source()
+        self._append(self._blocks(source) if source else [])
+
+    def visit_ReStSimpleTable(self,table,title=None,thead=False) :
+        nodes = self.nodes
+        num_cols, rows = table._cell_rows()
+        node = nodes.table()
+        if title :
+            node += nodes.title(title,'',*self._inline(title))
+        tgroup = nodes.tgroup(cols=num_cols)
+        node += tgroup
+        colspecs = [nodes.colspec() for i in range(num_cols)]
+        tgroup.extend(colspecs)
+        widths = [0]*num_cols
+        tbody = nodes.tbody()
+        tgroup += tbody
+        # the header row of the grid is not separated with '=', so it is a
+        # body row for docutils as well, list and csv tables have a real one
+        if table.header is not None :
+            header = table.header[:num_cols]+['']*(num_cols-len(table.header))
+            if thead :
+                head = nodes.thead()
+                tgroup.insert(tgroup.index(tbody),head)
+                head += self._row(header,widths)
+            else :
+                tbody += self._row(header,widths)
+        for row in rows :
+            tbody += self._row(row,widths)
+        # grid column widths include a space of padding on either side
+        for colspec, width in zip(colspecs,widths) :
+            colspec['colwidth'] = width+2
+        self._append([node])
+        return ReStVisitor.SKIP
+
+    def _row(self,cells,widths) :
+        nodes = self.nodes
+        row = nodes.row()
+        for i, cell in enumerate(cells) :
+            entry = nodes.entry()
+            if cell :
+                entry.extend(self._blocks(cell))
+                widths[i] = max([widths[i]]+[_display_width(l) for l in cell.split("\n")])
+            row += entry
+        return row
+
+    def visit_ReStTable(self,table) :
+        return self.visit_ReStSimpleTable(table._simp_table,title=table.title,thead=table.mode != 'grid')
+
+    def _image(self,image_fn,options) :
+        node = self.nodes.image(uri=image_fn)
+        for k,v in options.items() :
+            node[str(k)] = v if isinstance(v,int) and k == 'scale' else str(v)
+        return node
+
+    def visit_ReStImage(self,image) :
+        self._append([self._image(image.image_fn,image.options)])
+
+    def visit_ReStFigure(self,figure) :
+        nodes = self.nodes
+        node = nodes.figure()
+        node += self._image(figure.image_fn,figure.options)
+        if figure.caption :
+            node += nodes.caption(figure.caption,'',*self._inline(figure.caption))
+        self._append([node])
+
+    def visit_ReStHyperlink(self,link) :
+        if link.indirect or not link.url :
+            return self.visit_ReStBase(link)
+        nodes = self.nodes
+        node = nodes.target('','',refuri=link.url)
+        node['names'].append(nodes.fully_normalize_name(link.name))
+        self.document.note_explicit_target(node,node)
+        self._append([node])
+
+
+class ReStProfiler(object) :
+    '''Context manager recording how rendering time is spent across the
+    components of a document, e.g.::
+
+      >>> with ReStProfiler() as prof :
+      ...     doc.write()
+      >>> print prof.summary()
+
+    While active, every component built by *get_text()* or streamed by
+    *iter_text()* records the wall time, the number of characters produced
+    and its depth in the rendered tree, aggregated per component class and
+    per instance label.  Times and sizes are inclusive of nested components,
+    time spent by the consumer of *iter_text()* between chunks is not
+    counted.  The label of an instance is returned by the *label* function,
+    by default its title, name or file name if it has one.  *callback*, if
+    given, is called as ``callback(component,seconds,chars,depth)`` for every
+    recorded render.
+
+    The render walk checks for an active profiler once per *get_text()* or
+    *iter_text()* call and only uses the instrumented walk when there is one,
+    so profiling costs nothing when it is not in use.  Only one profiler may
+    be active at a time.
+    '''
+
+    _active = None
+
+    def __init__(self,label=None,callback=None) :
+        self.label = label or ReStProfiler.default_label
+        self.callback = callback
+        self.class_stats = {}
+        self.label_stats = {}
+        self._depth = 0
+
+    @staticmethod
+    def default_label(component) :
+        for attr in ('title','name','image_fn','fn') :
+            label = getattr(component,attr,None)
+            if isinstance(label,str) and label :
+                return label
+        return None
+
+    def __enter__(self) :
+        if ReStProfiler._active is not None :
+            raise ReStUtilException('Another ReStProfiler is already active')
+        ReStProfiler._active = self
+        return self
+
+    def __exit__(self,*exc_info) :
+        ReStProfiler._active = None
+        return False
+
+    def _record(self,component,seconds,chars,depth) :
+        cls_name = component.__class__.__name__
+        for stats, key in ((self.class_stats,cls_name),
+                           (self.label_stats,(cls_name,self.label(component)))) :
+            rec = stats.get(key)
+            if rec is None :
+                rec = stats[key] = {'calls':0,'seconds':0.,'chars':0,'max_depth':0}
+            rec['calls'] += 1
+            rec['seconds'] += seconds
+            rec['chars'] += chars
+            rec['max_depth'] = max(rec['max_depth'],depth)
+        if self.callback is not None :
+            self.callback(component,seconds,chars,depth)
+
+    def _build(self,component) :
+        # get_text() of a dirty component, _build_texts records the
+        # components below it
+        self._depth += 1
+        depth = self._depth
+        start = time.perf_counter()
+        try :
+            component.build_text()
+        finally :
+            self._depth -= 1
+        self._record(component,time.perf_counter()-start,len(component.text),depth)
+
+    def _iter_text(self,root) :
+        # _iter_text recording each component when its parts are exhausted.
+        # Only the time spent in the walk counts, the clock is stopped while
+        # a chunk is out with the consumer
+        clock = time.perf_counter
+        base = self._depth
+        elapsed, chars = 0., 0
+        prefixes, last = [''], '\n'
+        # frames are (parts, component, depth, elapsed and chars at entry,
+        # indent depth at entry)
+        stack = [(iter((root,)),None,base,0.,0,1)]
+        resumed = clock()
+        try :
+            while stack :
+                parts, comp, depth = stack[-1][:3]
+                # components built by get_text() inside iter_parts() record
+                # themselves, at the depth of the component they belong to
+                if comp is not None and type(comp).iter_parts is ReStBase.iter_parts :
+                    self._depth = depth-1
+                else :
+                    self._depth = depth
+                for part in parts :
+                    if not isinstance(part,str) :
+                        if isinstance(part,ReStIndent) :
+                            _apply_indent(prefixes,part,stack[-1][5])
+                            continue
+                        if part._dirty :
+                            stack.append((iter(part.iter_parts()),part,depth+1,
+                                          elapsed+clock()-resumed,chars,len(prefixes)))
+                            break
+                        part = part.text
+                    lead = ''
+                    if part :
+                        if len(prefixes) > 1 :
+                            lead, part = _indent(part,prefixes[-1],last[-1] == '\n')
+                        last = part
+                    chars += len(lead)+len(part)
+                    elapsed += clock()-resumed
+                    if lead :
+                        yield lead
+                    yield part
+                    resumed = clock()
+                else :
+                    parts, comp, depth, start, start_chars, indent_depth = stack.pop()
+                    del prefixes[indent_depth:]
+                    if comp is not None and type(comp).iter_parts is not ReStBase.iter_parts :
+                        self._record(comp,elapsed+clock()-resumed-start,chars-start_chars,depth)
+        finally :
+            self._depth = base
+
+    def summary(self,by='class') :
+        '''return a ReStSimpleTable of the recorded statistics sorted by time,
+        aggregated per component class if *by* is ``'class'`` or per class and
+        instance label if it is ``'label'``'''
+        if by == 'class' :
+            header = ['component','calls','seconds','chars','max depth']
+            rows = [[k]+[v['calls'],v['seconds'],v['chars'],v['max_depth']]
+                    for k,v in self.class_stats.items()]
+        elif by == 'label' :
+            header = ['component','label','calls','seconds','chars','max depth']
+            rows = [[k[0],k[1] or '']+[v['calls'],v['seconds'],v['chars'],v['max_depth']]
+                    for k,v in self.label_stats.items()]
+        else :
+            raise ReStUtilException('Unknown profile summary grouping %r, use class or label'%by)
+        rows.sort(key=lambda r: -r[-3])
+        return ReStSimpleTable(header,rows,
+                               formats={'seconds':'{:.6f}'},
+                               align={'calls':'right','seconds':'right',
+                                      'chars':'right','max depth':'right'})
 
-        self.text = rst_role_txt+html_style_txt
 
 # convenience functions for HTML style formatting
 role = lambda r: lambda x: ':%s:`%s`'%(r,x)
@@ -404,3 +3203,492 @@ role = lambda r: lambda x: ':%s:`%s`'%(r,x)
 for _r, _c in ReStHTMLStyle.DEFAULT_ROLES :
     locals()[_r] = role(_r)
 del _r, _c
+
+
+# compact serialization of component trees, see serialize()
+
+_SERIAL_MAGIC = b'reStUtil'
+_SERIAL_VERSION = 1
+_SERIAL_COMPRESSED = 1
+
+# components are stored a class at a time, each field as a column of
+# values, which are stored as marshal stores them, equal strings as one
+# object so marshal writes the later ones as references.  Tuples starting
+# with Ellipsis are tags: (..., node) is a component, (..., kind, payload)
+# one of the kinds below, and Ellipsis alone an unset slot
+_PICKLED, _TUPLE, _ROWS, _COLUMNS = 'ptrc'
+# column encodings of table data, the arrays of packed columns are in
+# native byte order
+_STR_COLUMN, _INT_COLUMN, _FLOAT_COLUMN, _VALUE_COLUMN = range(4)
+_PLAIN_TYPES = frozenset((str,int,float,bool,type(None),bytes))
+
+def _serial_fields(cls) :
+    # the slots of cls stored for its components, in mro order, and whether
+    # its components have a __dict__
+    names, has_dict = [], False
+    for klass in reversed(cls.__mro__) :
+        if klass is object :
+            continue
+        slots = klass.__dict__.get('__slots__')
+        if slots is None or '__dict__' in slots :
+            has_dict = True
+        for name in slots or () :
+            if name not in names and name not in ('_parents','_packed','__dict__','__weakref__') :
+                names.append(name)
+    return names, has_dict
+
+def _field_setter(cls,name) :
+    # sets the field without __setattr__, through the slot's descriptor
+    descriptor = getattr(cls,name,None)
+    if hasattr(descriptor,'__set__') :
+        return descriptor.__set__
+    return lambda obj,value: object.__setattr__(obj,name,value)
+
+class _Serializer(object) :
+    # encodes a component tree to the structures of the format.  Components
+    # are numbered in the order they are reached and encoded in batches of
+    # those reached from the previous batch, so the depth of the tree is not
+    # limited by the call stack
+    def __init__(self,keep_text) :
+        self.keep_text = keep_text
+        self.strings = {}
+        self.node_ids, self.pending = {}, []
+        self.schemas, self.schema_ids = [], {}
+
+    def run(self,root) :
+        self.component(root)
+        while self.pending :
+            batch, self.pending = self.pending, []
+            classes = {}
+            for component in batch :
+                classes.setdefault(type(component),[]).append(component)
+            for cls, components in classes.items() :
+                self.encode(cls,components)
+        return ([(name,names,array.array('I',ids).tobytes(),columns,extras)
+                 for name, names, ids, columns, extras, literal in self.schemas],)
+
+    def component(self,component) :
+        node_id = self.node_ids.get(id(component))
+        if node_id is None :
+            node_id = self.node_ids[id(component)] = len(self.node_ids)
+            self.pending.append(component)
+        return (Ellipsis,node_id)
+
+    def schema(self,cls) :
+        # [class name, field names, node ids, field columns, __dict__s or
+        # None, whether the text of cls is its content]
+        index = self.schema_ids.get(cls)
+        if index is None :
+            if '<locals>' in cls.__qualname__ :
+                raise ReStUtilException('Local class %s cannot be serialized'%cls.__qualname__)
+            names, has_dict = _serial_fields(cls)
+            literal = cls.build_text is ReStBase.build_text and cls.iter_parts is ReStBase.iter_parts
+            index = self.schema_ids[cls] = len(self.schemas)
+            self.schemas.append(['%s:%s'%(cls.__module__,cls.__qualname__),names,[],
+                                 [[] for name in names],[] if has_dict else None,literal])
+        return self.schemas[index]
+
+    def encode(self,cls,components) :
+        name, names, ids, columns, extras, literal = self.schema(cls)
+        ids.extend(map(self.node_ids.__getitem__,map(id,components)))
+        strings, value = self.strings, self.value
+        # text built from the other fields is left out, and rebuilt when
+        # needed, unless keep_text is set and the component is a built leaf
+        kept = None
+        if not literal and self.keep_text :
+            kept = [not c._dirty and not c._children() for c in components]
+        for name, column in zip(names,columns) :
+            if not literal and name in ('text','_dirty') and not (kept and any(kept)) :
+                column.extend(itertools.repeat('' if name == 'text' else True,len(components)))
+                continue
+            try :
+                values = list(map(operator.attrgetter(name),components))
+            except AttributeError :
+                values = [getattr(c,name,Ellipsis) for c in components]
+            if kept :
+                if name == 'text' :
+                    values = [v if k else '' for v,k in zip(values,kept)]
+                elif name == '_dirty' :
+                    values = [v if k else True for v,k in zip(values,kept)]
+            types = set(map(type,values))
+            if types == {str} :
+                values = list(map(strings.setdefault,values,values))
+            elif name == 'data' and issubclass(cls,ReStSimpleTable) :
+                # reading data above unpacked the rows of tables deserialized
+                # lazily
+                values = [self.table_data(c,v) for c,v in zip(components,values)]
+            elif not types <= _PLAIN_TYPES or str in types :
+                values = list(map(value,values))
+            column.extend(values)
+        if extras is not None :
+            extras.extend([value(c.__dict__) if getattr(c,'__dict__',None) else None
+                           for c in components])
+
+    def value(self,v) :
+        t = type(v)
+        if t is str :
+            return self.strings.setdefault(v,v)
+        elif t in _PLAIN_TYPES or v is Ellipsis :
+            return v
+        elif t is list or t is _ReStList :
+            return [self.value(x) for x in v]
+        elif t is tuple :
+            v = tuple([self.value(x) for x in v])
+            return (Ellipsis,_TUPLE,list(v)) if v and v[0] is Ellipsis else v
+        elif t is dict :
+            return dict(zip([self.value(k) for k in v],[self.value(x) for x in v.values()]))
+        elif isinstance(v,ReStBase) :
+            return self.component(v)
+        try :
+            return (Ellipsis,_PICKLED,pickle.dumps(v,pickle.HIGHEST_PROTOCOL))
+        except (pickle.PicklingError,TypeError,AttributeError) as e :
+            raise ReStUtilException('Cannot serialize %r: %s'%(v,e))
+
+    def table_data(self,table,data) :
+        # rectangular rows and column oriented data are stored column-wise
+        if table._spill is not None or (data is not None and not hasattr(data,'__len__')) :
+            raise ReStUtilException('Streamed table data cannot be serialized')
+        columnar = _as_columns(data)
+        if columnar is not None :
+            names, columns = columnar
+            return (Ellipsis,_COLUMNS,self.value(names),[self.column(c) for c in columns])
+        widths = set(map(len,data))
+        if len(widths) != 1 :
+            return self.value(data)
+        return (Ellipsis,_ROWS,len(data),[self.column(list(map(operator.itemgetter(i),data)))
+                                          for i in range(widths.pop())])
+
+    def column(self,values) :
+        types = set(map(type,values))
+        if types == {str} :
+            return (_STR_COLUMN,list(map(self.strings.setdefault,values,values)))
+        elif types == {float} :
+            return (_FLOAT_COLUMN,array.array('d',values).tobytes())
+        elif types == {int} :
+            try :
+                return (_INT_COLUMN,array.array('q',values).tobytes())
+            except OverflowError :
+                pass
+        return (_VALUE_COLUMN,[self.value(v) for v in values])
+
+def _unpack_table_data(data,decode) :
+    # the rows or columns of table data packed by _Serializer.table_data
+    def unpack(column) :
+        kind, values = column
+        if kind == _STR_COLUMN :
+            return values
+        elif kind == _FLOAT_COLUMN :
+            return array.array('d',values).tolist()
+        elif kind == _INT_COLUMN :
+            return array.array('q',values).tolist()
+        return list(map(decode,values))
+    if data[1] == _ROWS :
+        columns = list(map(unpack,data[3]))
+        return list(map(list,zip(*columns))) if columns else [[] for i in range(data[2])]
+    return dict(zip(data[2],map(unpack,data[3])))
+
+def _serial_class(name) :
+    module, qualname = name.split(':')
+    obj = importlib.import_module(module)
+    for attr in qualname.split('.') :
+        obj = getattr(obj,attr)
+    if not (isinstance(obj,type) and issubclass(obj,ReStBase)) :
+        raise ReStUtilException('Serialized class %s is not a ReStBase subclass'%name)
+    return obj
+
+def serialize(component,keep_text=False,compress=False) :
+    '''return *component*, and all of the components below it, as bytes in a
+    compact versioned format read back by *deserialize()*, for caching or
+    sending subtrees to other processes, e.g.::
+
+      >>> data = serialize(section)
+      >>> deserialize(data).get_text() == section.get_text()
+      True
+
+    Components are stored a class at a time with the field names given
+    once, strings are stored once however often they appear, and table data
+    column-wise, with columns of integers or floats packed in arrays.  Text
+    that components build from their other fields, such as the wrapped text
+    of a ReStText, is left out and rebuilt when needed.  With *keep_text*
+    the text of components without children that are already built is
+    kept, so they are not rendered again, e.g. tables.  *compress*
+    compresses the data with zlib.
+
+    Values other than components, strings, numbers, bytes, lists, tuples and
+    dicts, e.g. table *formats* functions, are pickled.  Rows of a table are
+    read back as lists and column oriented data as a dict of lists.
+    Streamed table data, and values that cannot be pickled, raise a
+    ReStUtilException.  As with pickle, only deserialize trusted data.'''
+    payload = marshal.dumps(_Serializer(keep_text).run(component),4)
+    flags = 0
+    if compress :
+        payload = zlib.compress(payload,1)
+        flags |= _SERIAL_COMPRESSED
+    return _SERIAL_MAGIC+bytes((_SERIAL_VERSION,flags))+payload
+
+def deserialize(data) :
+    '''return the component tree serialized in *data* by *serialize()*.  The
+    rows of tables are only unpacked from their columns when the table's
+    *data* is first used, so loading a document whose tables are not
+    rendered, or kept their text, stays fast.'''
+    if len(data) < len(_SERIAL_MAGIC)+2 or not data.startswith(_SERIAL_MAGIC) :
+        raise ReStUtilException('Not serialized reStUtil components')
+    version, flags = data[len(_SERIAL_MAGIC):len(_SERIAL_MAGIC)+2]
+    if version > _SERIAL_VERSION :
+        raise ReStUtilException('Serialized with a newer format version %d, %d is supported'%
+                                (version,_SERIAL_VERSION))
+    payload = data[len(_SERIAL_MAGIC)+2:]
+    if flags & _SERIAL_COMPRESSED :
+        payload = zlib.decompress(payload)
+    schemas, = marshal.loads(payload)
+
+    # create the components of every class before setting any field, which
+    # may refer to any of them
+    components = [None]*sum(len(ids)//4 for name, names, ids, columns, extras in schemas)
+    created = []
+    for name, names, ids, columns, extras in schemas :
+        cls = _serial_class(name)
+        ids = array.array('I',ids).tolist()
+        objs = list(map(cls.__new__,itertools.repeat(cls,len(ids))))
+        list(map(components.__setitem__,ids,objs))
+        created.append((cls,names,objs,columns,extras))
+
+    def decode(v) :
+        t = type(v)
+        if t in _PLAIN_TYPES or v is Ellipsis :
+            return v
+        elif t is list :
+            return [decode(x) for x in v]
+        elif t is dict :
+            return dict(zip([decode(k) for k in v],[decode(x) for x in v.values()]))
+        elif not v or v[0] is not Ellipsis :
+            return tuple([decode(x) for x in v])
+        elif len(v) == 2 :
+            return components[v[1]]
+        elif v[1] == _TUPLE :
+            return tuple([decode(x) for x in v[2]])
+        elif v[1] == _PICKLED :
+            return pickle.loads(v[2])
+        raise ReStUtilException('Unknown serialized value tag %r'%(v[1],))
+
+    for cls, names, objs, columns, extras in created :
+        list(map(_field_setter(cls,'_parents'),objs,itertools.repeat(None)))
+        table = issubclass(cls,ReStSimpleTable)
+        if table :
+            list(map(_field_setter(cls,'_packed'),objs,itertools.repeat(None)))
+        for name, values in zip(names,columns) :
+            set_field = _field_setter(cls,name)
+            if set(map(type,values)) <= _PLAIN_TYPES :
+                list(map(set_field,objs,values))
+                continue
+            for obj, v in zip(objs,values) :
+                if v is Ellipsis :
+                    continue
+                elif table and name == 'data' and type(v) is tuple and len(v) > 2 and \
+                     v[0] is Ellipsis and v[1] in (_ROWS,_COLUMNS) :
+                    # unpacked on first use, see ReStSimpleTable.__getattr__
+                    obj._packed = (v,decode)
+                else :
+                    v = decode(v)
+                    set_field(obj,_ReStList(obj,v) if type(v) is list and name in cls._LISTS else v)
+        if extras is not None :
+            for obj, extra in zip(objs,extras) :
+                if extra :
+                    obj.__dict__.update(decode(extra))
+    for component in components :
+        for child in component._children() :
+            component._adopt(child)
+    return components[0]
+
+
+# command line converter, python -m reStUtil
+
+_INPUT_FORMATS = {'.csv':'csv','.tsv':'tsv','.tab':'tsv','.jsonl':'jsonl','.ndjson':'jsonl'}
+
+def _parse_number(value) :
+    # csv fields are text, numeric formats need numbers
+    if isinstance(value,str) :
+        for convert in (int,float) :
+            try :
+                return convert(value)
+            except ValueError :
+                pass
+    return value
+
+def _cli_format(name,fmt) :
+    compiled = fmt.format if '{' in fmt else fmt.__mod__
+    def format_value(value) :
+        try :
+            return compiled(_parse_number(value))
+        except (ValueError,TypeError,IndexError,KeyError) as e :
+            raise ReStUtilException('--format %s=%s cannot format %r: %s'%(name,fmt,value,e))
+    return format_value
+
+def _format_rows(rows,formats) :
+    # rows with the cells of the {column index: function} *formats* formatted,
+    # done as the rows are read so errors can tell the row
+    for number, row in enumerate(rows,1) :
+        row = list(row)
+        try :
+            for index, format_value in formats.items() :
+                if index < len(row) :
+                    row[index] = format_value(row[index])
+        except ReStUtilException as e :
+            raise ReStUtilException('row %d: %s'%(number,e))
+        yield row
+
+def _key_values(specs,option) :
+    # NAME=VALUE command line arguments as a dict
+    values = {}
+    for spec in specs or () :
+        name, sep, value = spec.partition('=')
+        if not sep :
+            raise ReStUtilException('%s needs NAME=VALUE, not %r'%(option,spec))
+        values[name] = value
+    return values
+
+def _read_rows(f,input_format,delimiter,has_header,names) :
+    '''return (header, iterator over rows) for the text file *f*, header is
+    *names* if given, otherwise the first row or the keys of the first JSON
+    object, or None'''
+    if input_format == 'jsonl' :
+        records = (json.loads(line) for line in f if line.strip())
+        first = next(records,None)
+        if first is None :
+            return names, iter(())
+        records = itertools.chain((first,),records)
+        if isinstance(first,dict) :
+            header = names or list(first)
+            return header, (['' if r.get(k) is None else r.get(k) for k in header] for r in records)
+        return names, records
+    reader = csv.reader(f,delimiter=delimiter or (',' if input_format == 'csv' else '\t'))
+    header = names
+    if has_header :
+        first = next(reader,None)
+        if names is None :
+            header = first
+    return header, reader
+
+def _iter_input_rows(paths,args,header_box) :
+    # the rows of all inputs in turn, the header taken from the first one
+    for path in paths :
+        input_format = args.input_format or _INPUT_FORMATS.get(os.path.splitext(path)[1].lower(),'csv')
+        f = sys.stdin if path == '-' else open(path,newline='',encoding=args.encoding)
+        try :
+            header, rows = _read_rows(f,input_format,args.delimiter,not args.no_header,args.header)
+            if not header_box :
+                header_box.append(header)
+            for row in rows :
+                yield row
+        finally :
+            if f is not sys.stdin :
+                f.close()
+
+def _cli_components(args) :
+    '''generator yielding the top level components of the document made
+    from the inputs, a table or a section per group.  Rows are read as the
+    components are rendered, so each must be rendered before the next is
+    taken.'''
+    header_box = []
+    rows = _iter_input_rows(args.inputs or ['-'],args,header_box)
+    # the header is read with the first row
+    first = next(rows,None)
+    header = header_box[0] if header_box else args.header
+    if first is not None :
+        rows = itertools.chain((first,),rows)
+    if header is not None :
+        header = list(header)
+
+    formats = {}
+    for name, fmt in _key_values(args.format,'--format').items() :
+        if header is None or name not in header :
+            raise ReStUtilException('Unknown --format column %r, columns are %s'%(name,header))
+        formats[header.index(name)] = _cli_format(name,fmt)
+    if formats :
+        rows = _format_rows(rows,formats)
+    align = _key_values(args.align,'--align')
+    def table(header,rows) :
+        return ReStTable(header,rows,title=args.table_title or '',ignore_missing=args.ignore_missing,
+                         col_widths=args.widths,align=align or None,mode=args.table)
+
+    if args.group_by is None :
+        yield table(header,rows)
+        return
+    if header is None or args.group_by not in header :
+        raise ReStUtilException('Unknown --group-by column %r, columns are %s'%(args.group_by,header))
+    index = header.index(args.group_by)
+    group_header = header[:index]+header[index+1:]
+    for key, group in itertools.groupby(rows,operator.itemgetter(index)) :
+        section = ReStSection(str(key) or '(empty)')
+        section.add(table(group_header,(row[:index]+row[index+1:] for row in group)))
+        yield section
+
+def main(argv=None) :
+    '''convert CSV, TSV or JSON Lines to a reStructuredText document, run
+    with -h for the options'''
+    parser = argparse.ArgumentParser(prog='python -m reStUtil',
+                                     description='Convert CSV, TSV or JSON Lines data to reStructuredText '
+                                     'tables.  Rows are streamed, so inputs of any size convert in '
+                                     'constant memory.')
+    parser.add_argument('inputs',nargs='*',metavar='FILE',
+                        help='input files, read in turn as one table, - or none for stdin')
+    parser.add_argument('-o','--output',metavar='FILE',help='output file [stdout]')
+    parser.add_argument('-f','--input-format',choices=['csv','tsv','jsonl'],
+                        help='input format [from the file extension, else csv]')
+    parser.add_argument('-d','--delimiter',help='csv field delimiter [, or tab for tsv]')
+    parser.add_argument('--encoding',default='utf-8',help='input file encoding [%(default)s]')
+    parser.add_argument('--header',type=lambda s: s.split(','),metavar='NAMES',
+                        help='comma separated column names, in place of those of the input')
+    parser.add_argument('--no-header',action='store_true',
+                        help='the first csv or tsv row is data rather than the column names')
+    parser.add_argument('-t','--table',choices=ReStTable.MODES,default='grid',
+                        help='table markup [%(default)s], list and csv need no width pass')
+    parser.add_argument('--title',help='document title')
+    parser.add_argument('--table-title',help='title of the tables')
+    parser.add_argument('-g','--group-by',metavar='COLUMN',
+                        help='a section per run of rows with the same value in COLUMN, '
+                        'which is left out of the tables.  Sort the input by it first')
+    parser.add_argument('--format',action='append',metavar='COLUMN=FORMAT',
+                        help='format of a column, e.g. price={:.2f} or count=%%d, repeatable')
+    parser.add_argument('--align',action='append',metavar='COLUMN=ALIGN',
+                        help='alignment of a column, left, right or center, repeatable')
+    parser.add_argument('-w','--widths',type=lambda s: [int(w) for w in s.split(',')],metavar='WIDTHS',
+                        help='comma separated grid column widths, so grids are written in one pass '
+                        'rather than through a temporary file')
+    parser.add_argument('--ignore-missing',action='store_true',
+                        help='pad or truncate rows to the number of columns')
+    parser.add_argument('--max-rows',type=int,help='write tables of more rows to shard files')
+    parser.add_argument('--max-bytes',type=int,help='write sections and tables of more characters to shard files')
+    parser.add_argument('--shard-level',type=int,metavar='LEVEL',
+                        help='write the sections of this level to shard files')
+    parser.add_argument('--shard-dir',metavar='DIR',help='directory of the shard files [that of the output]')
+    args = parser.parse_args(argv)
+
+    if args.output in (None,'-') :
+        out = doc_file = sys.stdout
+    else :
+        out, doc_file = None, args.output
+    try :
+        doc = ReStDocument(doc_file,title=args.title)
+        sharder = None
+        if args.max_rows is not None or args.max_bytes is not None or args.shard_level is not None :
+            sharder = doc._sharder(args.max_bytes,args.max_rows,args.shard_level,args.shard_dir)
+
+        def rendered() :
+            components = itertools.chain(list(doc.components),_cli_components(args))
+            for index, component in enumerate(components) :
+                if sharder is None :
+                    yield component, component.iter_text()
+                else :
+                    yield component, (sharder(component,index)[0],)
+        doc._write_components(rendered())
+    except (ReStUtilException,ValueError,OSError,csv.Error) as e :
+        sys.stderr.write('%s: error: %s\n'%(parser.prog,e))
+        return 1
+    finally :
+        if out is None and 'doc' in locals() :
+            doc.close()
+    return 0
+
+if __name__ == '__main__' :
+    sys.exit(main())
@@ -0,0 +1,267 @@
+import io
+import os
+import sys
+import threading
+
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..'))
+
+from reStUtil import *
+
+
+def test_reservation_conflicting_hyperlink() :
+    # a conflict found when a reservation is done must not leave a writer
+    # waiting on it, and must not be written
+    doc = ReStDocument(io.StringIO())
+    doc.add(ReStHyperlink('x','http://a'))
+    slot = doc.reserve()
+    errors = []
+    def write() :
+        try :
+            doc.write()
+        except ReStUtilException as e :
+            errors.append(e)
+    writer = threading.Thread(target=write)
+    writer.start()
+    with slot :
+        slot.add(ReStHyperlink('x','http://different'))
+    writer.join(10)
+    assert not writer.is_alive()
+    assert len(errors) == 1 and 'x' in str(errors[0])
+    assert 'http://different' not in doc._f.getvalue()
+
+def test_conflicting_hyperlink_behind_reservation() :
+    doc = ReStDocument(io.StringIO())
+    doc.add(ReStHyperlink('x','http://a'))
+    slot = doc.reserve()
+    doc.add(ReStHyperlink('x','http://b'))
+    slot.done()
+    with pytest.raises(ReStUtilException) :
+        doc.get_text()
+
+def test_awrite_reservation_filled_on_loop() :
+    # waiting for a reservation must not block the loop filling it
+    import asyncio
+    doc = ReStDocument(io.StringIO())
+    slot = doc.reserve()
+    doc.add('after')
+    async def fill() :
+        await asyncio.sleep(0.05)
+        with slot :
+            slot.add('filled')
+    async def main() :
+        await asyncio.wait_for(asyncio.gather(fill(),doc.awrite()),10)
+    asyncio.run(main())
+    assert doc._f.getvalue() == '\nfilled\n\nafter\n\n'
+
+def test_serialize_roundtrip() :
+    sec = ReStSection('Section')
+    shared = ReStText('shared *text*')
+    sec.add(shared,ReStHyperlink('x','http://a'),shared)
+    sec.add(ReStTable(['a','b','c'],[['r%d'%i,i*1.5,i] for i in range(100)],title='T'))
+    sec.add(ReStSimpleTable(None,{'x':[1,2],'y':['p',None]}))
+    sec.add(ReStSimpleTable(['a','b'],[[1,(Ellipsis,2)],[10**30,ReStText('cell')]]))
+    copy = deserialize(serialize(sec))
+    assert copy.get_text() == sec.get_text()
+    assert copy.components[0] is copy.components[2]
+    assert deserialize(serialize(sec,keep_text=True,compress=True)).get_text() == sec.get_text()
+
+def test_write_sharded_memory_budget(tmp_path) :
+    doc = ReStDocument(str(tmp_path/'doc.rst'),memory_budget=20000)
+    for i in range(20) :
+        sec = ReStSection('Section %d'%i)
+        sec.add(ReStTable(['a'],[[j] for j in range(200)]))
+        doc.add(sec)
+    with pytest.raises(ReStUtilException) :
+        doc.write_sharded(max_rows=100)
+    doc.close()
+
+def test_write_sharded_streamed_rows(tmp_path) :
+    # streamed rows go to a shard only once there are more than max_rows
+    doc = ReStDocument(str(tmp_path/'doc.rst'))
+    doc.add(ReStTable(['a'],([i] for i in range(2)),title='small'))
+    doc.add(ReStTable(['a'],([i] for i in range(5)),title='large'))
+    doc.write_sharded(max_rows=3)
+    doc.close()
+    text = open(str(tmp_path/'doc.rst')).read()
+    assert 'small' in text and 'large' not in text
+    assert text.count('.. include::') == 1
+
+def test_main_reports_errors(tmp_path,capsys) :
+    from reStUtil import main
+    path = tmp_path/'in.csv'
+    path.write_text('name,count\na,1234\nb,\n')
+    out = str(tmp_path/'out.rst')
+    assert main([str(path),'-o',out,'--format','count={:,d}']) == 1
+    assert 'row 2:' in capsys.readouterr().err
+    assert main([str(tmp_path/'missing.csv'),'-o',out]) == 1
+    assert 'missing.csv' in capsys.readouterr().err
+
+@pytest.mark.parametrize('text',['----','(1) foo','a. bar','A. Einstein','iv. four',':field: x',
+                                 '-v  verbose','term\n  definition','x::','Title\n=====','  quote',
+                                 '/V  x','+---+\n| a |\n+---+','- item','#. x','.. note:: x',
+                                 ':::',':b::',':x:::','\\\\','a\n\\\\\\'])
+@pytest.mark.parametrize('mode',['inline','literal'])
+def test_escape_text_docutils(text,mode) :
+    # escaped text is a paragraph of the text as is
+    core = pytest.importorskip('docutils.core')
+    from docutils import nodes
+    tree = core.publish_doctree('para\n\n%s\n'%escape_text(text,mode),
+                                settings_overrides={'report_level':5,'warning_stream':False})
+    kinds = set(type(n).__name__ for n in tree.findall(nodes.Element))
+    assert kinds <= {'document','paragraph','literal'}
+    assert tree.astext().split() == ['para']+text.split()
+
+@pytest.mark.parametrize('mode',['inline','literal'])
+def test_text_escaped_after_wrapping(mode) :
+    # wrapping must not make markup of escaped text
+    core = pytest.importorskip('docutils.core')
+    from docutils import nodes
+    text = 'Result '+'x'*70+' ============ - item'
+    tree = core.publish_doctree('para\n\n'+ReStText(text,width=20,escape=mode).get_text(),
+                                settings_overrides={'report_level':5,'warning_stream':False})
+    kinds = set(type(n).__name__ for n in tree.findall(nodes.Element))
+    assert kinds <= {'document','paragraph','literal'}
+    assert tree.astext().split() == ['para']+fill_text(text,20).split()
+
+def test_fill_text_width_within_indent() :
+    import textwrap
+    assert fill_text('a 5',1,'','  ') == 'a\n  5'
+    for width in range(1,6) :
+        assert fill_text('ab cd  ef',width,'   ','  ') == \
+            textwrap.fill('ab cd  ef',width,initial_indent='   ',subsequent_indent='  ',break_long_words=True)
+
+def test_image_options_dict() :
+    options = {}
+    img = ReStImage('a.png',options)
+    assert img.options is options
+    img.options['width'] = 100
+    fig = ReStFigure('b.png','caption')
+    fig.options['scale'] = 50
+    assert ':width: 100' in img.get_text() and ':scale: 50' in fig.get_text()
+    assert deserialize(serialize(fig)).get_text() == fig.get_text()
+
+def test_add_drops_duplicate_hyperlinks() :
+    doc = ReStDocument(io.StringIO())
+    doc.add(ReStHyperlink('a','http://a'))
+    sec = ReStSection('T')
+    link = ReStHyperlink('a','http://a')
+    sec.add('x',link,ReStHyperlink('b','http://b'),link)
+    doc.add(sec,ReStHyperlink('a','http://a'))
+    assert [type(c).__name__ for c in sec.components] == ['ReStText','ReStHyperlink']
+    assert sorted(doc.targets) == ['a','b','t']
+    assert doc.get_text().count('.. _a:') == 1
+
+def test_components_changed_in_place() :
+    # appending to components, as the document docstring suggests, is seen
+    # after the text is cached
+    doc = ReStDocument(io.StringIO())
+    sec = ReStSection('S')
+    doc.components.append(sec)
+    doc.get_text()
+    sec.add('x')
+    assert 'x' in doc.get_text()
+    table = ReStSimpleTable(['a'],[['r1']])
+    sec.components += [table]
+    doc.get_text()
+    table.data.append(['r2'])
+    assert 'r2' in doc.get_text()
+    del sec.components[0]
+    assert '\nx\n' not in doc.get_text()
+    copy = deserialize(serialize(doc))
+    copy.components[0].components.append(ReStText('y'))
+    assert 'y' in copy.get_text()
+    import pickle
+    copy = pickle.loads(pickle.dumps(doc.components[0]))
+    copy.get_text()
+    copy.components.append(ReStText('z'))
+    assert 'z' in copy.get_text()
+
+class _Note(ReStBase) :
+    # a subclass in the old style, not calling ReStBase.__init__
+    def __init__(self,body) :
+        self.body = body
+
+    def build_text(self) :
+        self.text = '.. note:: %s\n'%self.body
+
+def test_subclass_without_base_init() :
+    note = _Note('first')
+    sec = ReStSection('S')
+    sec.add(note)
+    assert '.. note:: first' in sec.get_text()
+    note.body = 'second'
+    assert '.. note:: second' in sec.get_text()
+    include = ReStInclude('a.rst')
+    assert include.get_text() == '.. include:: a.rst\n\n'
+
+def test_csv_file_next_to_document(tmp_path,monkeypatch) :
+    monkeypatch.chdir(tmp_path)
+    os.mkdir('reports')
+    doc = ReStDocument(os.path.join('reports','r.rst'),skip_unchanged=True)
+    doc.add(ReStTable(['a','b'],[[1,'x'],[2,'y']],mode='csv',csv_file='r_data.csv'))
+    doc.write()
+    path = os.path.join('reports','r_data.csv')
+    assert open(path).read() == '*a*,*b*\n1,x\n2,y\n'
+    assert not os.path.exists('r_data.csv')
+    os.utime(path,(0,0))
+    doc.components[0].title = 'changed'
+    doc.write()
+    assert os.stat(path).st_mtime == 0
+
+def test_fill_text_matches_textwrap(monkeypatch) :
+    # long paragraphs take the uncached path
+    import reStUtil
+    monkeypatch.setattr(reStUtil,'WRAP_CACHE_MAX_LEN',100)
+    import random
+    import textwrap
+    rand = random.Random(9)
+    words = ['a','bc','def','ghij','klmnopqrstuvwxyz','x'*30,'-','a-b','c--d','e.','f?']
+    for i in range(2000) :
+        text = ''.join(rand.choice(words)+rand.choice([' ','  ','\n','\t',' '])
+                       for j in range(rand.randrange(20)))
+        initial = ' '*rand.randrange(5)
+        subsequent = ' '*rand.randrange(5)
+        width = rand.randrange(max(len(initial),len(subsequent))+1,60)
+        assert fill_text(text,width,initial,subsequent) == \
+            textwrap.fill(text,width,initial_indent=initial,subsequent_indent=subsequent), (text,width)
+
+def _sample_document(f) :
+    doc = ReStDocument(f)
+    for i in range(6) :
+        sec = ReStSection('Section %d'%i)
+        sec.add('text *%d* with a link_'%i,ReStHyperlink('link%d'%i,'http://a/%d'%i))
+        sec.add(ReStTable(['a','b'],[[j,'x'*j] for j in range(i+2)],title='T%d'%i))
+        sec.add(ReStFigure('f%d.png'%i,'caption %d'%i))
+        doc.add(sec)
+    return doc
+
+@pytest.mark.parametrize('threads',[False,True])
+def test_parallel_write_matches_serial(tmp_path,threads) :
+    _sample_document(str(tmp_path/'serial.rst')).write()
+    _sample_document(str(tmp_path/'parallel.rst')).write(workers=3,threads=threads)
+    assert (tmp_path/'parallel.rst').read_bytes() == (tmp_path/'serial.rst').read_bytes()
+
+_TABLE_HEADER = ['name','value','note']
+_TABLE_ROWS = [['a*b',1.5,'x\ny'],['c',22.25,''],['long name',-3.0,'z_']]
+
+@pytest.mark.parametrize('kwargs',[{},{'max_col_width':4},{'escape':'inline'},
+                                   {'formats':{'value':'{:.1f}'},'align':{'value':'right'}}])
+@pytest.mark.parametrize('mode',[None,'grid','list','csv'])
+def test_columnar_table_matches_rows(mode,kwargs) :
+    columns = dict((n,[r[i] for r in _TABLE_ROWS]) for i,n in enumerate(_TABLE_HEADER))
+    if mode is None :
+        make = lambda data : ReStSimpleTable(_TABLE_HEADER,data,**kwargs)
+    else :
+        make = lambda data : ReStTable(_TABLE_HEADER,data,mode=mode,**kwargs)
+    assert make(columns).get_text() == make(_TABLE_ROWS).get_text()
+
+@pytest.mark.parametrize('col_widths',[None,[9,5,2]])
+@pytest.mark.parametrize('mode',[None,'grid','list','csv'])
+def test_streamed_table_matches_list(mode,col_widths) :
+    if mode is None :
+        make = lambda data : ReStSimpleTable(_TABLE_HEADER,data,col_widths=col_widths)
+    else :
+        make = lambda data : ReStTable(_TABLE_HEADER,data,mode=mode,col_widths=col_widths,block_size=2)
+    assert make(iter(_TABLE_ROWS)).get_text() == make(_TABLE_ROWS).get_text()